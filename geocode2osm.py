@@ -7,14 +7,34 @@
 # Geocoded file will be written to input_filename + "_geocoded.osm"
 # Log is written to "_log.txt"
 # ADDRESS format: "Skøyen skole, Lørenveien 7, 0585 Oslo" (optional first part)
+# CSV, GeoJSON and NDJSON files with an ADDRESS column or property are also supported, or "-" for standard input
 
 
 import json
 import sys
 import urllib.request, urllib.parse, urllib.error
+import http.client
+import gzip
 import csv
 import time
 import re
+import os
+import sqlite3
+import threading
+import concurrent.futures
+import multiprocessing
+import zipfile
+import collections
+import itertools
+import functools
+import random
+import math
+import atexit
+import queue
+import email.utils
+import asyncio
+import signal
+import stat
 from io import TextIOWrapper
 from xml.etree import ElementTree
 
@@ -23,731 +43,3423 @@ version = "1.0.0"
 
 header = {"User-Agent": "osm-no/geocode2osm"}
 
+http_timeout = 30  # Seconds before a query is given up and retried
+
+http_gzip = True  # Ask services for compressed responses
+
+max_redirects = 5  # Max number of redirects to follow for one query
+
 max_nominatim = 500  # Max number of Nominatim calls during one hour
 
-pause_nominatim = True  # Wait one hour for next Nominatim batch (else do only first batch)
+pause_nominatim = True  # Wait for next Nominatim batch within the hour (else do only first batch)
 
+# Max number of queries per period (seconds) for each service. Queries wait until allowed by all limits.
 
-# Translation table for other information than street names
+rate_limits = {
+	'nominatim': [(1, 1), (max_nominatim, 60 * 60)],  # Usage policy: Max 1 query per second
+	'matrikkel': [],
+	'ssr': [],
+	'kommuneinfo': []
+}
 
-fix_name = [
-	("Rådhuset", "Rådhus"),
-	("Kommunehuset", "Kommunehus"),
-	("Herredshuset", "Herredshus"),
-	("Heradshuset", "Heradshus"),
-	("st.", "stasjon"),
-	("sk.", "skole"),
-	("vgs.", "videregående skole"),
-	("v.g.s.", "videregående skole"),
-	("b&u", "barne og ungdom")
-	]
+retry_tries = 5  # Number of attempts for each query before the query is given up
 
+retry_delay = 2  # Seconds before first retry, doubled for each retry and randomly shortened by up to half
 
-# Translation table for street name corrections
-# Code will also test i) without ".", ii) with preceding "s" and iii) will test combinations with synonyms
+retry_max_delay = 60  # Max seconds between retries, also when the service asks for a longer wait (Retry-After)
 
-street_synonyms = [
-	['gata', 'gaten', 'gate', 'gt.', 'g.'],
-	['veien', 'vegen', 'vei', 'veg', 'vn.', 'v.'],
-	['plassen', 'plass', 'pl.'],
-	['torv', 'torg'],
-	['bro', 'bru'],
-	['brygga', 'bryggen', 'bryggja', 'bryggje', 'brygge', 'br.'],
-	['løkken', 'løkka', 'løkke'],
-	['stuen', 'stua', 'stue'],
-	['hagen', 'haven', 'haga', 'hage', 'have'],
-	['viken', 'vika', 'vik'],
-	['aleen', 'alle'],
-	['fjorden', 'fjord'],
-	['bukten', 'bukta', 'bukt'],
-	['jordet', 'jord'],
-	['kollen', 'kolle'],
-	['åsen', 'ås'],
-	['sletten', 'sletta', 'slette'],
-	['verket', 'verk'],
-	['toppen', 'topp'],
-	['gamle', 'gml.'],
-	['kirke', 'kyrkje', 'krk.'],
-	['skole', 'skule', 'sk.'],
-	['ssons', 'ssens', 'sons', 'sens', 'sson', 'ssen', 'son', 'sen'],
-	['theodor', 'th.'],
-	['christian', 'chr.'],
-	['kristian', 'kr.'],
-	['johannes', 'johs.'],
-	['edvard', 'edv.']
-	]
+breaker_failures = 3  # Number of failed queries in a row before a service is skipped
 
+breaker_pause = 5 * 60  # Seconds to skip a failing service before it is tried again
 
-# This table is not yet supported in the code:
+query_cache = True  # Keep responses from Matrikkel, SSR and Nominatim in a local cache between runs
 
-extra_synonyms = [
-	['kirke', 'kyrkje'],
-	['skole', 'skule'],
-	['videregående skole', 'videregåande skule'],
-	['rådhus', 'rådhuset'],
-	['kommunehus', 'kommunehuset'],
-	['herredshus', 'herredshuset', 'heradshus', 'heradshuset'],
-	['krk.', 'kirke'],
-	['st.', 'stasjon'],
-	['v.g.s.', 'videregående skole']
-	]
+cache_readonly = False  # Use cached responses but do not store new ones
 
+cache_ttl = 30  # Number of days before a cached response expires
 
-# Table for testing genitive/word separation variations
+cache_commit = 100  # Number of new responses before they are saved to the cache file
 
-genitive_tests = [
-	('',   ' ' ),  # Example: 'Snorresveg'  -> 'Snorres veg'
-	(' ',  ''  ),  # Example: 'Snorres veg' -> 'Snorresveg'
-	('',   's' ),  # Example: 'Snorreveg'   -> 'Snorresveg' 
-	('',   's '),  # Example: 'Snorreveg'   -> 'Snorres veg'
-	(' ',  's '),  # Example: 'Snorre veg'  -> 'Snorres veg'
-	(' ',  's' ),  # Example: 'Snorre veg'  -> 'Snorresveg'	
-	('s ', ' ' ),  # Example: 'Snorres veg' -> 'Snorre veg'
-	('s',  ''  ),  # Example: 'Snorresveg'  -> 'Snorreveg'
-	('s',  ' ' )   # Example: 'Snorresveg'  -> 'Snorre veg'
-]
+memo_size = 100000  # Max number of responses kept in memory during a run, the least recently used are dropped first
 
+cache_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode2osm_cache.db")
 
-# Output message
+bbox_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "municipality_bbox.json")  # Bounding box per municipality
 
-def message (line):
+post_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "postnummerregister.json")  # Parsed postal code register
 
-	sys.stdout.write (line)
-	sys.stdout.flush()
+post_refresh = 7  # Number of days before postal code register is loaded again from Posten
 
+max_workers = 1  # Number of addresses to geocode in parallel (Nominatim queries are still done one at a time)
 
-# Log query results
+max_processes = 1  # Number of processes geocoding municipalities in parallel, each with max_workers
 
-def log(log_text):
+shard_size = 500  # Max number of addresses from one municipality given to a process at a time
 
-	log_file.write(log_text)
+speculative = False  # Test exact address variants and synonyms for each address in parallel
 
+speculative_workers = 8  # Number of parallel queries when testing address variants
 
-# Open file/api, try up to 5 times, each time with double sleep time
+refresh_registers = False  # Load postal code register and name types again even if saved copies are recent
 
-def try_urlopen (url):
+stream_window = 1000  # Max number of elements kept in memory while geocoding
 
-	tries = 0
-	while tries < 5:
-		try:
-			return urllib.request.urlopen(url)
+address_column = "ADDRESS"  # Column in CSV files, or property in GeoJSON files, with address in the ADDRESS tag format
 
-		except urllib.error.HTTPError as e:
-			if e.code in [429, 503, 504]:  # "Too many requests", "Service unavailable" or "Gateway timed out"
-				if tries  == 0:
-					message ("\n") 
-				message ("\r\tRetry %i in %ss... " % (tries + 1, 5 * (2**tries)))
-				time.sleep(5 * (2**tries))
-				tries += 1
-			else:
-				message ("\n\nHTTP error %i: %s\n" % (e.code, e.reason))
-				message ("%s\n" % url.get_full_url())
-				sys.exit()
+address_columns = []  # Columns with street, house number, postcode and city, used instead of address_column (no address parsing)
 
-		except urllib.error.URLError as e:  # Mostly "Connection reset by peer"
-			if tries  == 0:
-				message ("\n") 
-			message ("\r\tRetry %i in %ss... " % (tries + 1, 5 * (2**tries)))
-			time.sleep(5 * (2**tries))
-			tries += 1
-	
-	message ("\n\nError: %s\n" % e.reason)
-	message ("%s\n\n" % url.get_full_url())
-	sys.exit()
+input_format = ""  # Format of input file: "osm", "csv", "geojson" or "ndjson" (else given by file extension)
 
+defer_nominatim = False  # Geocode all addresses with Matrikkel and SSR first, then addresses which need Nominatim
 
-# Concatenate address line
+deferred_batch = 100  # Number of deferred addresses to geocode with Nominatim in parallel
 
-def get_address(street, house_number, postal_code, city):
+deferred_update = 30 * 60  # Seconds between updates of the output file while geocoding deferred addresses
 
-	address = street
-	if house_number:
-		address = address + " " + house_number  # Includes letter
-	if address:
-		address = address + ", "
-	if postal_code:
-		address = address + postal_code + " "
-	if city:
-		address = address + city
+matrikkel_extract = ""  # Address register CSV file (or zip) from Kartverket, used instead of Matrikkel queries
 
-	return address.strip()
+ssr_extract = ""  # Place name CSV file (or zip) from SSR, used instead of SSR queries
 
+ssr_groups = ['Bebyggelse', 'OffentligAdministrasjon', 'Kultur']  # Accepted main groups of SSR name types
 
-# Geocoding with Nominatim
+precision_target = "house"  # Required precision: "house", "street", "place" or "post district". Street name variants are skipped if more precise.
 
-def nominatim_search (query_type, query_text, query_municipality, method):
+strategies_filename = ""  # JSON file with geocoding strategies, used instead of the built-in strategies (default_strategies)
 
-	global nominatim_count, batch_count, bbox, last_nominatim_time
+stats_report = True  # Save report with calls, hits and time used for each geocoding method (JSON and CSV)
 
-	# Observe policy of 1 second delay between queries
-	time_now = time.time()
-	if time_now < last_nominatim_time + 1:
-		time.sleep(1 - time_now + last_nominatim_time)
+log_level = "info"  # Log level: "debug" also logs full responses, "warning" only logs problems
 
-	if not(bbox):
-		bbox = get_municipality_data(query_municipality)
+server_host = "127.0.0.1"  # Network address of geocoding service (-serve port), only local clients by default
 
-	url = "https://nominatim.openstreetmap.org/search?%s=%s&countrycodes=no&viewbox=%f,%f,%f,%f&format=json&limit=10" \
-							% (query_type, urllib.parse.quote(query_text),
-								bbox['longitude_min'], bbox['latitude_min'], bbox['longitude_max'], bbox['latitude_max'])
+server_batch = 1000  # Max number of addresses in one request to the geocoding service
 
-	request = urllib.request.Request(url, headers=header)
-	file = try_urlopen(request)
-	result = json.load(file)
-	file.close()
+server_request_size = 10 * 1024 * 1024  # Max size of request body in bytes
 
-	log ("Nominatim (%s): %s=%s\n" % (method, query_type, query_text))
-	log (json.dumps(result, indent=2))
-	log ("\n")
-	nominatim_count += 1
-	batch_count += 1
-	last_nominatim_time = time.time()
+server_quota_wait = 10  # Max seconds a request to the geocoding service waits for the rate limit of a service, else the service fails
 
-	if result:
-		if (result[0]['class'] != "boundary") or (result[0]['type'] != "administrative"):  # Skip administrative boundaries (municipalities)
-			result = result[0]
-		elif len(result) > 1:
-			result = result[1]
-		else:
-			return None
+quota_wait = None  # Max seconds to wait for the rate limit of a service before the query fails (None: no limit)
 
-		# Check if coordinates are within the bounding box of the municipality
+ssr_types_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "navnetyper.json")  # SSR name types
 
-		latitude = float(result['lat'])
-		longitude = float(result['lon'])
+ssr_types_refreshed_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "navnetyper_refreshed.json")  # SSR name types loaded with -refresh, used instead of ssr_types_filename
 
-		if (latitude > bbox['latitude_min']) and (latitude < bbox['latitude_max']) and \
-			(longitude > bbox['longitude_min']) and (longitude < bbox['longitude_max']):
-			result_type = "Nominatim/%s -> %s/%s" % (method, result['class'], result['type'])
-			if result['class'] == "highway":
-				result_quality = "street"
-			elif method.find("address") >= 0:
-				result_quality = "place"
-			else:
-				result_quality = "post district"
-			return (result['lat'], result['lon'], result_type, result_quality)
-		else:
-			log ("Nominatim result not within bounding box of municipality\n")
-			return None
 
-	else:
-		return None
+# Locks for data shared between worker threads
 
+count_lock = threading.Lock()
+cache_lock = threading.Lock()
+register_lock = threading.Lock()
+http_lock = threading.Lock()
+ssr_types_lock = threading.Lock()
+bbox_lock = threading.Lock()
+nominatim_lock = threading.Lock()
 
-# Geocoding with Matrikkel Vegadresse
+log_buffer = threading.local()  # Log lines for the address being geocoded in the current thread
 
-def matrikkel_search (street, house_number, house_letter, post_code, city, municipality_ref, method):
+ssr_types = None  # SSR name types, loaded when first needed
 
-	global matrikkel_count
+http_pool = {}  # Open connections for each host which are not in use, kept alive for the next query
 
-	# Build query string. Use municipality instead of postcode/city if available
-	query = ""
-	if street:
-		query += "sok=%s" % urllib.parse.quote(street.replace("(","").replace(")","").replace(":",""))
-	if house_number:
-		query += "&nummer=%s" % house_number
-	if house_letter:
-		query += "&bokstav=%s" % house_letter
-	if post_code and not(municipality_ref):
-		query += "&postnummer=%s" % post_code
-	if city and not(municipality_ref):
-		query += "&poststed=%s" % urllib.parse.quote(city)
-	if municipality_ref:
-		query += "&kommunenummer=%s" % municipality_ref
+http_proxies = urllib.request.getproxies()  # Proxies from environment (HTTPS_PROXY etc.)
 
-	url = "https://ws.geonorge.no/adresser/v1/sok?" + query + "&treffPerSide=10"
+log_levels = { 'debug': 10, 'info': 20, 'warning': 30 }
 
-	request = urllib.request.Request(url, headers=header)
-	file = try_urlopen(request)
-	result = json.load(file)
-	file.close()
+log_writer = None  # Background writer of log file
 
-	result = result['adresser']
+message_file = sys.stdout  # Messages are written to standard error when the output file is written to standard output
 
-	log ("Matrikkel (%s): %s\n" % (method, urllib.parse.unquote(query)))  # .encode('ASCII')).decode('utf-8')))
-	log (json.dumps(result, indent=2))
-	log ("\n")
-	matrikkel_count += 1
+geocoding_ready = False  # Registers, cache and strategies are loaded
 
-	if result:
-		result_type = "Matrikkel/%s -> %s" % (method, result[0]['objtype'])
-		latitude = result[0]['representasjonspunkt']['lat']
-		longitude = result[0]['representasjonspunkt']['lon']
-		if method.find("address") >= 0:
-			result_quality = "house"
-		else:
-			result_quality = "place"
-		return (str(latitude), str(longitude), result_type, result_quality)
-	else:
-		return None
+nominatim_deferred = False  # Nominatim queries are deferred until other addresses are geocoded
 
 
-# Geocoding with SSR
+# Counters for this run
 
-def ssr_search (query_text, query_municipality, method):
+nominatim_count = 0
+ssr_count = 0
+matrikkel_count = 0
+tried_count = 0
+geocode_count = 0
+failed_count = 0
+cache_count = 0
+memo_count = 0
+address_memo_count = 0
+variant_count = 0
+variant_query_count = 0
+ssr_not_found = []
+strategy_stats = {}  # Calls, hits and time used for each step and method of the strategies during this run
 
-	global ssr_count, ssr_not_found
+hits = {
+	'house': 0,
+	'street': 0,
+	'place': 0,
+	'post district': 0
+}
 
-	query = "https://ws.geonorge.no/SKWS3Index/ssr/json/sok?navn=%s&epsgKode=4326&fylkeKommuneListe=%s&eksakteForst=true" \
-				% (urllib.parse.quote(query_text.replace("(","").replace(")","")), query_municipality)
-	request = urllib.request.Request(query, headers=header)
-	file = try_urlopen(request)
-	result = json.load(file)
-	file.close()
+query_memo = collections.OrderedDict()  # Responses to queries during this run, least recently used first
+address_memo = {}  # Geocoding tasks for addresses during this run
 
-	log ("SSR (%s): %s, municipality #%s\n" % (method, query_text, query_municipality))
-	log (json.dumps(result, indent=2))
-	log ("\n")
-	ssr_count += 1
 
-	if "stedsnavn" in result:
-		if isinstance(result['stedsnavn'], dict):  # Single result is not in a list
-			result['stedsnavn'] = [ result['stedsnavn'] ]
+# Sliding window rate limiter shared by all worker threads.
+# Limits are given as a list of (max number of calls, period in seconds).
 
-		# Check if name type is defined in category table
-		for place in result['stedsnavn']:
-			if not(place['navnetype'].lower().strip() in ssr_types):
-				message ("\n\t**** SSR name type '%s' not found - please post issue at 'https://github.com/osmno/geocode2osm' ****\n\n"\
-							% place['navnetype'])
-				log ("SSR name type '%s' not found\n" % place['navnetype'])
-				if not(place['navnetype'] in ssr_not_found):
-					ssr_not_found.append(place['navnetype'])
+class RateLimiter:
 
-		# Return the first acceptable result
-		for place in result['stedsnavn']:
-			if (place['navnetype'].lower().strip() in ssr_types) and \
-					(ssr_types[ place['navnetype'].lower().strip() ] in ['Bebyggelse', 'OffentligAdministrasjon', 'Kultur']):
-				result_type = "SSR/%s -> %s" % (method, place['navnetype'].strip())
-				if method == "street":
-					result_quality = "place"
-				else:
-					result_quality = "post district"
-				return (place['nord'], place['aust'], result_type, result_quality)
-	
-	return None
+	def __init__ (self, name, limits):
 
+		self.name = name
+		self.limits = limits
+		self.lock = threading.Lock()
+		self.calls = collections.deque()  # Time of calls within the longest period
+		self.longest_period = max([ period for max_calls, period in limits ] + [0])
+		self.call_count = 0  # Number of calls during this run
 
-# Load bounding box for given municipality ref
 
-def get_municipality_data (query_municipality):
+	# Seconds to wait until next call is allowed by all limits
 
-	bbox = {
-		'latitude_min': 90.0,
-		'latitude_max': -90.0,
-		'longitude_min': 180.0,
-		'longitude_max': -180.0
-		}
+	def delay (self, time_now):
 
-	if query_municipality and (query_municipality != "2100"):  # Exclude Svalbard
-		query = "https://ws.geonorge.no/kommuneinfo/v1/kommuner/%s" % query_municipality
-		request = urllib.request.Request(query, headers=header)
-		file = try_urlopen(request)
-		result = json.load(file)
-		file.close()
+		while self.calls and (self.calls[0] <= time_now - self.longest_period):
+			self.calls.popleft()
 
-		for node in result['avgrensningsboks']['coordinates'][0][1:]:
-			bbox['latitude_max'] = max(bbox['latitude_max'], node[1])
-			bbox['latitude_min'] = min(bbox['latitude_min'], node[1])
-			bbox['longitude_max'] = max(bbox['longitude_max'], node[0])
-			bbox['longitude_min'] = min(bbox['longitude_min'], node[0])
+		delay = 0
+		for max_calls, period in self.limits:
+			if len(self.calls) >= max_calls:
+				recent_calls = [ call for call in self.calls if call > time_now - period ]
+				if len(recent_calls) >= max_calls:
+					delay = max(delay, recent_calls[ len(recent_calls) - max_calls ] + period - time_now)
 
-		log ("Bounding box for municipality #%s: (%f, %f) (%f, %f)\n" % \
-			(query_municipality, bbox['latitude_min'], bbox['longitude_min'], bbox['latitude_max'], bbox['longitude_max']))
-	else:
-		bbox = {
-			'latitude_min': -90.0,
-			'latitude_max': 90.0,
-			'longitude_min': -180.0,
-			'longitude_max': 180.0
-			}
+		return delay
 
-	return bbox
 
+	# Wait until next call is allowed, and register the call. Other threads calling the same service wait in line.
+	# Raises ServiceError if the wait would be longer than max_wait seconds.
 
-# Look up synonyms and genitive variations
+	def wait (self, max_wait=None):
 
-def try_synonyms (street, house_number, house_letter, postcode, city, municipality_ref):
+		if not(self.limits):
+			return
 
-	low_street = street.lower() + " "
+		with self.lock:
+			delay = self.delay(time.time())
+			if (max_wait is not None) and (delay > max_wait):
+				raise ServiceError(self.name.lower(), "rate limit, next query in %i seconds" % delay)
+			while delay > 0:
+				if delay > 60:
+					message ("\n\tWaiting %i minutes for %s quota...\n" % (delay // 60 + 1, self.name))
+				time.sleep(delay)
+				delay = self.delay(time.time())
 
-	# Iterate all synonyms (twice for abbreviations)
+			self.calls.append(time.time())
+			self.call_count += 1
 
-	for synonyms in street_synonyms:
-		found = False
 
-		for synonym_word in synonyms:
+	# Number of calls during this run
 
-			if "." in synonym_word:
-				test_list = [synonym_word, synonym_word[:-1]]  # Abreviation with and without period
-			else:
-				test_list = [synonym_word]
+	def total_calls (self):
 
-			for test_word in test_list:
+		return self.call_count
 
-				# Test synonyms, including abbreviations
 
-				found_position = low_street.rfind(test_word + " ")
-				if found_position >= 0:
-					found = True
+# Rate limiter shared by several processes. Time of the latest calls is kept in a shared array (ring buffer),
+# which must have room for the largest number of calls in the limits.
 
-					for synonym_replacement in synonyms:
-						if (synonym_replacement != synonym_word) and not("." in synonym_replacement):
+class SharedRateLimiter(RateLimiter):
 
-							new_street = low_street[0:found_position] + low_street[found_position:].replace(test_word, synonym_replacement)
-							result = matrikkel_search (new_street, house_number, house_letter, postcode, city, municipality_ref, "address+synonymfix")
-							if (result):
-								return result
-
-#							# Test genitive "s" -> "s " for each synonym (this is the most common case)
-#
-#							if (found_position > 0) and (low_street[ found_position - 1 ] == "s"):
-#								new_street = low_street[0:found_position - 1] + \
-#												low_street[found_position - 1:].replace(test_word, " " + synonym_replacement)
-#								result = matrikkel_search (new_street, house_number, house_letter, postcode, city, municipality_ref, \
-#															"address+synonymfix+genitivefix")
-#								if (result):
-#									return result
+	def __init__ (self, name, limits, lock, call_times, call_count):
 
-						# Test genitive variations
+		RateLimiter.__init__(self, name, limits)
+		self.lock = lock  # Process lock
+		self.call_times = call_times
+		self.shared_count = call_count
 
-						if (found_position > 1) and not("sen" in synonyms):
-							for genitive_test in genitive_tests:
-								if ((low_street[found_position - 1] != " ") or (" " in genitive_test[0])) and\
-									((low_street[found_position - 1] != "s") and (low_street[found_position - 2:found_position] != "s ")\
-										or not("s" in genitive_test[1])):
 
-									new_street = low_street[0:found_position - 2] + \
-										low_street[found_position - 2:].replace(genitive_test[0] + test_word, genitive_test[1] + synonym_replacement)
-#									new_street = low_street[0:found_position - 2] + \
-#													low_street[found_position - 2:].replace(genitive_test[0] + test_word, genitive_test[1] + test_word)
-									if new_street != low_street:
-										result = matrikkel_search (new_street, house_number, house_letter, postcode, city, municipality_ref, \
-																	"address+genitivefix")
-										if (result):
-											return result
+	# Wait until next call is allowed by calls from all processes, and register the call
 
-			if found:
-				break  # Already match in synonym group, so no need to test rest of the group
+	def wait (self, max_wait=None):
 
-	return None
+		if not(self.limits):
+			return
 
+		with self.lock:
+			self.calls = collections.deque(sorted(call for call in self.call_times if call > 0))
+			delay = self.delay(time.time())
+			if (max_wait is not None) and (delay > max_wait):
+				raise ServiceError(self.name.lower(), "rate limit, next query in %i seconds" % delay)
+			while delay > 0:
+				if delay > 60:
+					message ("\n\tWaiting %i minutes for %s quota...\n" % (delay // 60 + 1, self.name))
+				time.sleep(delay)
+				delay = self.delay(time.time())
 
-# Main program
+			oldest = min(range(len(self.call_times)), key=self.call_times.__getitem__)
+			self.call_times[ oldest ] = time.time()
+			self.shared_count.value += 1
 
-if __name__ == '__main__':
 
-	# Read all data into memory
+	# Number of calls from all processes during this run
 
-	message ("\nLoading data...")
-	
-	if len(sys.argv) > 1:
-		filename = sys.argv[1]
-	else:
-		message ("Please include input osm filename as parameter\n")
-		sys.exit()
+	def total_calls (self):
 
-	tree = ElementTree.parse(filename)
+		return self.shared_count.value
 
-	# Load post code districts from Posten
 
-	post_filename = 'https://www.bring.no/postnummerregister-ansi.txt'
-	file = urllib.request.urlopen(post_filename)
-	postal_codes = csv.DictReader(TextIOWrapper(file, "windows-1252"), fieldnames=['post_code','post_city','municipality_ref','municipality_name','post_type'], delimiter="\t")
-	post_districts = {}
+# Circuit breaker for a service. The service is skipped for a while after several failed queries in a row,
+# then tried again with one query.
 
-	for row in postal_codes:
-		entry = {
-			'city': row['post_city'],
-			'municipality_ref': row['municipality_ref'],
-			'municipality_name': row['municipality_name'],
-			'type': row['post_type'],  # G, P or B
-			'multiple': False
-		}
+class CircuitBreaker:
 
-		# Discovre possible multiples post code districts for the same city name
-		if entry['type'] == "G":
-			for post_code, post in iter(post_districts.items()):
-				if (post['city'] == entry['city']) and (post['type'] == "G"):
-					post['multiple'] = True
-					entry['multiple'] = True
+	def __init__ (self, name):
 
-		post_districts[row['post_code']] = entry
+		self.name = name
+		self.lock = threading.Lock()
+		self.failures = 0  # Failed queries in a row
+		self.open_until = 0  # Time until the service is skipped
 
-	# Load name categories from Github
 
-	ssr_filename = 'https://raw.githubusercontent.com/osmno/geocode2osm/master/navnetyper.json'
-	file = urllib.request.urlopen(ssr_filename)
-	name_codes = json.load(file)
-	file.close()
+	# Return True if the service may be queried now
 
-	ssr_types = {}
-	for main_group in name_codes['navnetypeHovedgrupper']:
-		for group in main_group['navnetypeGrupper']:
-			for name_type in group['navnetyper']:
-				ssr_types[ name_type['visningsnavn'].strip().lower() ] = main_group['navn']
+	def allow (self):
 
-	# Init output files
+		with self.lock:
+			if self.open_until > time.time():
+				return False
+			if self.failures >= breaker_failures:
+				self.open_until = time.time() + breaker_pause  # Only one query while testing service again
+			return True
 
-	message ("\nGeocoding ADDRESS tag for objects marked with GEOCODE tag in file '%s'...\n\n" % filename)
 
-	if filename.find(".osm") >= 0:
-		log_filename = filename.replace(".osm", "_geocodelog.txt")
-	else:
-		log_filename = filename + "_geocodelog.txt"
+	# Register successful query
 
-	log_file = open(log_filename, "w")
+	def success (self):
 
-	nominatim_count = 0
-	batch_count = 0
-	ssr_count = 0
-	matrikkel_count = 0
-	tried_count = 0
-	geocode_count = 0
-	ssr_not_found = []
-	last_nominatim_time = time.time()
+		with self.lock:
+			self.failures = 0
+			self.open_until = 0
 
-	hits = {
-		'house': 0,
-		'street': 0,
-		'place': 0,
-		'post district': 0
-	}
 
-	root = tree.getroot()
+	# Register failed query. Skip the service for the given time, or after too many failures in a row.
 
-	# Loop through all elements
+	def failure (self, pause=0):
 
-	for node in root.iter('node'):
+		with self.lock:
+			self.failures += 1
+			if (self.failures >= breaker_failures) or pause:
+				self.open_until = time.time() + max(pause, breaker_pause)
+				message ("\n\t%s is not available, skipped for %i minutes\n" % (self.name, max(pause, breaker_pause) // 60))
 
-		address_tag = node.find("tag[@k='ADDRESS']")
-		geocode_tag = node.find("tag[@k='GEOCODE']")
 
-		if (geocode_tag != None) and (address_tag != None) and (geocode_tag.get("v").lower() not in ["no", "done"]):
+# Log file written by a background thread, so that geocoding does not wait for the file
 
-			# Decompose address into street, house number, letter, postcode and city
-			# Address format: "Skøyen skole, Lørenveien 7, 0585 Oslo" (optional first part)
+class LogWriter:
 
-			tried_count += 1
-			address = address_tag.get("v")
-			message ("%i %s " % (tried_count, address))	
-			log ("\nADDRESS %i: %s\n" % (tried_count, address))
+	def __init__ (self, filename, mode):
 
-			address_split = address.split(",")
-			length = len(address_split)
-			for i in range(length):
-				address_split[i] = address_split[i].strip()
+		self.file = open(filename, mode, encoding="utf-8", buffering=1024 * 1024)
+		self.queue = queue.SimpleQueue()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+		atexit.register(self.close)  # Keep the log also if the program stops with an error
 
-			if length > 1:
-				street = address_split[length - 2]
-				postcode = address_split[length - 1][0:4]
-				city = address_split[length - 1][5:].strip()
-				house_number = ""
-				house_letter = ""
 
-				reg = re.search(r'(.*) [0-9]+[ \-\/]+([0-9]+)[ ]*([A-Za-z]?)$', street)
-				if not(reg):
-					reg = re.search(r'(.*) ([0-9]+)[ ]*([A-Za-z]?)$', street)				
-				if reg:
-					street = reg.group(1).strip()
-					house_number = reg.group(2).upper()
-					house_letter = reg.group(3)
+	# Write queued log lines until closed
 
-				if length > 2:
-					street_extra = ", ".join(address_split[0:length - 2])
-				else:
-					street_extra = ""
+	def run (self):
 
-				# Better match in Nominatim
-				for swap in fix_name:
-					street = street.replace(swap[0], swap[1] + " ").replace("  "," ").strip()
-					street_extra = street_extra.replace(swap[0], swap[1] + " ").replace("  "," ").strip()
+		while True:
+			text = self.queue.get()
+			if text is None:
+				break
+			self.file.write(text)
 
-			else:
-				street = ""
-				street_extra = ""
-				house_number = ""
-				house_letter = ""
-				postcode = address[0:4]
-				city = address[5:].strip()
-
-			if postcode in post_districts:
-				municipality_ref = post_districts[postcode]['municipality_ref']
-				municipality_name = post_districts[postcode]['municipality_name']
-				postcode_name = post_districts[postcode]['city']
-			else:
-				municipality_ref = ""
-				municipality_name = ""
-				postcode_name = ""
-				log ("Post code %s not found in Posten table\n" % postcode)
+		self.file.close()
 
-			# Attempt to geocode address
 
-			log ("[%s], [%s] [%s][%s], [%s] [%s (%s)]\n" % (street_extra, street, house_number, house_letter, postcode, city, postcode_name))
-			log ("Municipality #%s: %s\n" % (municipality_ref, municipality_name))
+	# Queue log lines for writing
 
-			result = None
-			bbox = None
+	def write (self, text):
 
-			# First try to find exact location
-			if street:
+		self.queue.put(text)
 
-				# Start testing exact addresses
-				if house_number:
 
-					# With both postcode and city
-					result = matrikkel_search (street, house_number, house_letter, postcode, city, "", "address")
+	# Write remaining log lines and close file
 
-					# Without city
-					if not(result):
-						result = matrikkel_search (street, house_number, house_letter, postcode, "", "", "address+postcode")
+	def close (self):
 
-					# Without postcode
-					if not(result):
-						result = matrikkel_search (street, house_number, house_letter, "", city, "", "address+city")
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
 
-					# With municipality instead of postcode and city
-					if not(result) and municipality_ref:
-						result = matrikkel_search (street, house_number, house_letter, "", "", municipality_ref, "address+municipality")
 
-					# Try fixes for abbreviations, synonyms and genitive ortography
-					if not(result):
-						result = try_synonyms (street, house_number, house_letter, postcode, city, municipality_ref)
+# Raised when a query has failed after all retries, or when the service is skipped by its circuit breaker
 
-				# If no house number is given, the street attribute ofte contains a place name
-				if not(result) and not(house_number) and municipality_ref:
-					result = ssr_search (street, municipality_ref, "street")
+class ServiceError(Exception):
 
-				# Try Nominatim to discover amenities etc.
-				if not(result) and street_extra and municipality_name:
-					result = nominatim_search ("q", get_address(street_extra, "", "", municipality_name),\
-								municipality_ref, "address+extra")
+	def __init__ (self, backend, reason):
 
-				if not(result) and municipality_name:
-					result = nominatim_search ("q", get_address(street, house_number, "", municipality_name), municipality_ref, "address")
+		Exception.__init__(self, "%s: %s" % (backend, reason))
+		self.backend = backend
 
-				# Finally, try to look up street name in Matrikkel addresses
-				if not(result) and not(house_number):  # Todo: Rare hits from this section - investigate results
-					result = matrikkel_search (street, "", "", postcode, city, municipality_ref, "street")
 
-					if not(result) and postcode_name and (postcode_name != city.upper()) and not(municipality_ref):
-						result = matrikkel_search (street, "", "", postcode, "", "", "street+postcode")
+# Decomposed address. Conditions used by geocoding strategies are included.
 
-			# Try to find village of post district if only one district per city
-			if not(result) and city and municipality_ref:
+class ParsedAddress:
 
-				# Find city location if city has only one post district
-				if post_districts[postcode]['multiple'] == False:
-					result = ssr_search (city, municipality_ref, "city")
+	__slots__ = ['street_extra', 'street', 'house_number', 'house_letter', 'postcode', 'city',
+					'postcode_name', 'municipality_ref', 'municipality_name',
+					'single_district', 'postcode_name_differs', 'municipality_name_differs']
 
-					if not(result) and (postcode_name != city.upper()):
-						result = ssr_search (postcode_name, municipality_ref, "postname")
+	def __init__ (self):
 
-					if not(result) and municipality_name:
-						result = nominatim_search ("q", get_address (city, "", "", municipality_name), municipality_ref, "city")
+		self.street_extra = ""
+		self.street = ""
+		self.house_number = ""
+		self.house_letter = ""
+		self.postcode = ""
+		self.city = ""
+		self.postcode_name = ""
+		self.municipality_ref = ""
+		self.municipality_name = ""
+		self.single_district = False
+		self.postcode_name_differs = False
+		self.municipality_name_differs = False
 
-			# Try to find polygon center of post district (may give results a long way from villages)
-			if not(result) and postcode:
-				result = nominatim_search ("postalcode", postcode, municipality_ref, "postcode")
 
-			# Try to find village center of city
-			if not(result) and city and municipality_ref:
-				result = ssr_search (city, municipality_ref, "city")
+	# Address parts as dict, for logging
 
-				if not(result) and (postcode_name != city.upper()):
-					result = ssr_search (postcode_name, municipality_ref, "postname")
+	def as_dict (self):
 
-			# As a last resort, just look up name of post code district
-			if not(result) and postcode_name:
-				if municipality_name != city.upper():
-					result = nominatim_search ("q", get_address (postcode_name, "", "", municipality_name), municipality_ref, "city")
+		return { field: getattr(self, field) for field in self.__slots__ }
 
-				if not(result):
-					result = nominatim_search ("city", postcode_name, municipality_ref, "city")
 
-			# If successful, update coordinates and save geocoding details for information
+# Geocoding strategy: which backend to query with which parts of the address, and the precision of the result
 
-			if result:
+class Strategy:
 
-				latitude = result[0]
-				longitude = result[1]
-				result_type = result[2]
-				result_quality = result[3]
+	def __init__ (self, config, step):
 
-				node.set("lat", latitude)
-				node.set("lon", longitude)
-				node.set("action", "modify")
+		self.step = step  # Position in the list of strategies, to tell strategies with the same method apart in the report
+		self.backend = config['backend']
+		self.method = config['method']
+		self.requires = config.get('requires', [])
+		self.without = config.get('without', [])
+		self.query = config['query']
+		self.query_type = config.get('type', "q")
+		self.variants = config.get('variants', False)
+		self.quality = config['quality']
+		self.speculative = config.get('speculative', False)
 
-				tag = node.find("tag[@k='GEOCODE_METHOD']")
-				if tag != None:
-					tag.set("v", result_type)
-				else:
-					node.append(ElementTree.Element("tag", k="GEOCODE_METHOD", v=result_type))
 
-				tag = node.find("tag[@k='GEOCODE_RESULT']")
-				if tag != None:
-					tag.set("v", result_quality)
-				else:
-					node.append(ElementTree.Element("tag", k="GEOCODE_RESULT", v=result_quality))
+	# Return True if the address has the parts needed for the strategy
 
-				message ("--> %s (%s)\n" % (result_type, result_quality))
-				log ("MATCH WITH %s (precision: %s)\n" % (result_type, result_quality))
-				geocode_count += 1
+	def applies (self, address_parts):
+
+		return all(getattr(address_parts, part) for part in self.requires) and not(any(getattr(address_parts, part) for part in self.without))
+
+
+	# Searches to perform for the address, as a list of (search function, parameters)
+
+	def candidates (self, address_parts):
+
+		if self.backend == "matrikkel":
+			search = functools.partial(matrikkel_search, step=self.step)
+			parts = [ getattr(address_parts, part) if part in self.query else "" for part in ['street', 'house_number', 'postcode', 'city', 'municipality_ref'] ]
+			house_letter = address_parts.house_letter if "house_number" in self.query else ""
+			if self.variants:
+				variants = synonym_variants(address_parts.street)
+				count_variants(len(variants))
+				return [ (search, (new_street, parts[1], house_letter, parts[2], parts[3], parts[4], self.quality, method))
+							for new_street, method in variants ]
+			else:
+				return [ (search, (parts[0], parts[1], house_letter, parts[2], parts[3], parts[4], self.quality, self.method)) ]
 
-				hits[result_quality] += 1
+		elif self.backend == "ssr":
+			return [ (functools.partial(ssr_search, step=self.step), (getattr(address_parts, self.query[0]), address_parts.municipality_ref, self.quality, self.method)) ]
 
+		else:
+			if len(self.query) == 1:
+				query_text = getattr(address_parts, self.query[0])
 			else:
-				message ("--> NO MATCH\n")
-				log ("NO MATCH\n")
+				house_number = address_parts.house_number if "house_number" in self.query else ""
+				query_text = get_address(getattr(address_parts, self.query[0]), house_number, "", getattr(address_parts, self.query[-1]))
+			return [ (functools.partial(nominatim_search, step=self.step), (self.query_type, query_text, address_parts.municipality_ref, self.quality, self.method)) ]
 
-				tag = node.find("tag[@k='GEOCODE_RESULT']")
-				if tag != None:
-					tag.set("v", "no match")
-				else:	
-					node.append(ElementTree.Element("tag", k="GEOCODE_RESULT", v="not found"))
 
-				tag = node.find("tag[@k='GEOCODE_METHOD']")
-				if tag != None:
-					node.remove(tag)
+	# Perform searches one by one until a result is found
 
-			geocode_tag.set("v", "done")  # Do not geocode next time
+	def run (self, address_parts):
 
-			# Limit Nominatim calls per hour to observe usage policy
+		for search_function, search_parameters in self.candidates(address_parts):
+			result = search_function(*search_parameters)
+			if result:
+				return result
 
-			if batch_count >= max_nominatim:
-				if pause_nominatim:
-					message ("Sleep for one hour\n")
-					batch_count = 0
-					time.sleep(60*60)  # SLeep one hour
-				else:
-					message ("Exceeded %i Nominatim calls per hour\n" % max_nominatim)
-					break
+		return None
 
-	# Wrap up
 
-	if filename.find(".osm") >= 0:
-		filename = filename.replace(".osm", "_geocoded.osm")
-	else:
-		filename = filename + "_geocoded.osm"
+# Raised when the first batch of Nominatim calls is used and pause_nominatim is off
+
+class NominatimLimitReached(Exception):
+	pass
+
+
+# Raised when an address needs a Nominatim query during the first pass with deferred Nominatim queries
+
+class NominatimDeferred(Exception):
+	pass
+
+
+# Translation table for other information than street names
+
+fix_name = [
+	("Rådhuset", "Rådhus"),
+	("Kommunehuset", "Kommunehus"),
+	("Herredshuset", "Herredshus"),
+	("Heradshuset", "Heradshus"),
+	("st.", "stasjon"),
+	("sk.", "skole"),
+	("vgs.", "videregående skole"),
+	("v.g.s.", "videregående skole"),
+	("b&u", "barne og ungdom")
+	]
+
+fix_name_pattern = re.compile("|".join(re.escape(old_name) for old_name, new_name in fix_name))
+fix_name_replacement = dict(fix_name)
+spaces_pattern = re.compile(r"  +")
+
+
+# Patterns for house number at end of street or in a separate column, with or without range of numbers (the last number is used)
+
+house_range_pattern = re.compile(r'(.*) [0-9]+[ \-\/]+([0-9]+)[ ]*([A-Za-z]?)$')
+house_number_pattern = re.compile(r'(.*) ([0-9]+)[ ]*([A-Za-z]?)$')
+house_field_pattern = re.compile(r'(?:[0-9]+[ \-\/]+)?([0-9]+)[ ]*([A-Za-z]?)$')
+
 
-	tree.write(filename, encoding='utf-8', method='xml', xml_declaration=True)
+# Patterns for start of features array in GeoJSON file, and for separators between features
 
-	log ("\nNominatim queries:  %i\n" % nominatim_count)
-	log ("Matrikkel queries:  %i\n" % matrikkel_count)
-	log ("SSR queries:        %i\n" % ssr_count)
+features_pattern = re.compile(r'"features"\s*:\s*\[')
+separator_pattern = re.compile(r'[\s,]*')
 
-	log ("\nHouse hits:         %s\n" % hits['house'])
-	log ("Street hits:        %s\n" % hits['street'])
-	log ("Place hits:         %s\n" % hits['place'])
-	log ("Post district hits: %s\n" % hits['post district'])
-	log ("No hits:            %s\n" % (tried_count - geocode_count))
 
-	message ("\nGeocoded %i of %i objects, written to file '%s'\n" % (geocode_count, tried_count, filename))
+# Translation table for street name corrections
+# Code will also test i) without ".", ii) with preceding "s" and iii) will test combinations with synonyms
+
+street_synonyms = [
+	['gata', 'gaten', 'gate', 'gt.', 'g.'],
+	['veien', 'vegen', 'vei', 'veg', 'vn.', 'v.'],
+	['plassen', 'plass', 'pl.'],
+	['torv', 'torg'],
+	['bro', 'bru'],
+	['brygga', 'bryggen', 'bryggja', 'bryggje', 'brygge', 'br.'],
+	['løkken', 'løkka', 'løkke'],
+	['stuen', 'stua', 'stue'],
+	['hagen', 'haven', 'haga', 'hage', 'have'],
+	['viken', 'vika', 'vik'],
+	['aleen', 'alle'],
+	['fjorden', 'fjord'],
+	['bukten', 'bukta', 'bukt'],
+	['jordet', 'jord'],
+	['kollen', 'kolle'],
+	['åsen', 'ås'],
+	['sletten', 'sletta', 'slette'],
+	['verket', 'verk'],
+	['toppen', 'topp'],
+	['gamle', 'gml.'],
+	['kirke', 'kyrkje', 'krk.'],
+	['skole', 'skule', 'sk.'],
+	['ssons', 'ssens', 'sons', 'sens', 'sson', 'ssen', 'son', 'sen'],
+	['theodor', 'th.'],
+	['christian', 'chr.'],
+	['kristian', 'kr.'],
+	['johannes', 'johs.'],
+	['edvard', 'edv.']
+	]
+
+
+# This table is not yet supported in the code:
+
+extra_synonyms = [
+	['kirke', 'kyrkje'],
+	['skole', 'skule'],
+	['videregående skole', 'videregåande skule'],
+	['rådhus', 'rådhuset'],
+	['kommunehus', 'kommunehuset'],
+	['herredshus', 'herredshuset', 'heradshus', 'heradshuset'],
+	['krk.', 'kirke'],
+	['st.', 'stasjon'],
+	['v.g.s.', 'videregående skole']
+	]
+
+
+# Table for testing genitive/word separation variations
+
+genitive_tests = [
+	('',   ' ' ),  # Example: 'Snorresveg'  -> 'Snorres veg'
+	(' ',  ''  ),  # Example: 'Snorres veg' -> 'Snorresveg'
+	('',   's' ),  # Example: 'Snorreveg'   -> 'Snorresveg' 
+	('',   's '),  # Example: 'Snorreveg'   -> 'Snorres veg'
+	(' ',  's '),  # Example: 'Snorre veg'  -> 'Snorres veg'
+	(' ',  's' ),  # Example: 'Snorre veg'  -> 'Snorresveg'	
+	('s ', ' ' ),  # Example: 'Snorres veg' -> 'Snorre veg'
+	('s',  ''  ),  # Example: 'Snorresveg'  -> 'Snorreveg'
+	('s',  ' ' )   # Example: 'Snorresveg'  -> 'Snorre veg'
+]
+
+
+# Precision of results, from most to least precise
+
+precisions = ["house", "street", "place", "post district"]
+
+
+# Fields used from each hit in responses from the services
+
+response_fields = {
+	'nominatim': ['class', 'type', 'lat', 'lon'],
+	'matrikkel': ['objtype', 'representasjonspunkt'],
+	'ssr': ['navnetype', 'nord', 'aust']
+}
+
+
+# Geocoding strategies, tested in this order until a result is found. May be replaced by a JSON file with -strategies.
+#   backend:     "matrikkel", "ssr" or "nominatim"
+#   method:      name of the strategy, used in GEOCODE_METHOD
+#   requires:    address parts which must be present, or conditions which must be true
+#   without:     address parts which must be missing
+#   query:       address parts to include in the query (ssr: the name; nominatim: first part, house number and last part)
+#   type:        nominatim query type ("q", "postalcode" or "city")
+#   variants:    test street name variants with synonyms and genitive variations (matrikkel)
+#   quality:     result precision ("house", "street", "place" or "post district")
+#   speculative: test in parallel with the other consecutive speculative strategies in speculative mode
+
+default_strategies = [
+	{ 'backend': "matrikkel", 'method': "address", 'requires': ["street", "house_number"],
+		'query': ["street", "house_number", "postcode", "city"], 'quality': "house", 'speculative': True },
+	{ 'backend': "matrikkel", 'method': "address+postcode", 'requires': ["street", "house_number"],
+		'query': ["street", "house_number", "postcode"], 'quality': "house", 'speculative': True },
+	{ 'backend': "matrikkel", 'method': "address+city", 'requires': ["street", "house_number"],
+		'query': ["street", "house_number", "city"], 'quality': "house", 'speculative': True },
+	{ 'backend': "matrikkel", 'method': "address+municipality", 'requires': ["street", "house_number", "municipality_ref"],
+		'query': ["street", "house_number", "municipality_ref"], 'quality': "house", 'speculative': True },
+	{ 'backend': "matrikkel", 'method': "address+variants", 'requires': ["street", "house_number"], 'variants': True,
+		'query': ["street", "house_number", "postcode", "city", "municipality_ref"], 'quality': "house", 'speculative': True },
+
+	# If no house number is given, the street attribute often contains a place name
+	{ 'backend': "ssr", 'method': "street", 'requires': ["street", "municipality_ref"], 'without': ["house_number"],
+		'query': ["street"], 'quality': "place" },
+
+	# Try Nominatim to discover amenities etc.
+	{ 'backend': "nominatim", 'method': "address+extra", 'requires': ["street", "street_extra", "municipality_name"],
+		'query': ["street_extra", "municipality_name"], 'quality': "place" },
+	{ 'backend': "nominatim", 'method': "address", 'requires': ["street", "municipality_name"],
+		'query': ["street", "house_number", "municipality_name"], 'quality': "place" },
+
+	# Look up street name in Matrikkel addresses (rare hits)
+	{ 'backend': "matrikkel", 'method': "street", 'requires': ["street"], 'without': ["house_number"],
+		'query': ["street", "postcode", "city", "municipality_ref"], 'quality': "place" },
+	{ 'backend': "matrikkel", 'method': "street+postcode", 'requires': ["street", "postcode_name", "postcode_name_differs"],
+		'without': ["house_number", "municipality_ref"], 'query': ["street", "postcode"], 'quality': "place" },
+
+	# Village of post district if only one district per city
+	{ 'backend': "ssr", 'method': "city", 'requires': ["city", "municipality_ref", "single_district"],
+		'query': ["city"], 'quality': "post district" },
+	{ 'backend': "ssr", 'method': "postname", 'requires': ["city", "municipality_ref", "single_district", "postcode_name_differs"],
+		'query': ["postcode_name"], 'quality': "post district" },
+	{ 'backend': "nominatim", 'method': "city", 'requires': ["city", "municipality_ref", "single_district", "municipality_name"],
+		'query': ["city", "municipality_name"], 'quality': "post district" },
+
+	# Polygon center of post district (may give results a long way from villages)
+	{ 'backend': "nominatim", 'method': "postcode", 'requires': ["postcode"], 'type': "postalcode",
+		'query': ["postcode"], 'quality': "post district" },
+
+	# Village center of city
+	{ 'backend': "ssr", 'method': "city", 'requires': ["city", "municipality_ref"],
+		'query': ["city"], 'quality': "post district" },
+	{ 'backend': "ssr", 'method': "postname", 'requires': ["city", "municipality_ref", "postcode_name_differs"],
+		'query': ["postcode_name"], 'quality': "post district" },
+
+	# As a last resort, just look up name of post code district
+	{ 'backend': "nominatim", 'method': "city", 'requires': ["postcode_name", "municipality_name_differs"],
+		'query': ["postcode_name", "municipality_name"], 'quality': "post district" },
+	{ 'backend': "nominatim", 'method': "city", 'requires': ["postcode_name"], 'type': "city",
+		'query': ["postcode_name"], 'quality': "post district" }
+]
+
+
+# Output message
+
+def message (line):
+
+	message_file.write (line)
+	message_file.flush()
+
+
+# Write lines to log. Worker threads keep log lines until the address is completed.
+
+def log_lines (log_text):
+
+	lines = getattr(log_buffer, "lines", None)
+	if lines is not None:
+		lines.append(log_text)
+	elif log_writer:
+		log_writer.write(log_text)
+
+
+# Log event as one compact JSON line, if the level is within the log level
+
+def log (level, event, **fields):
+
+	if log_levels[ level ] >= log_levels[ log_level ]:
+		record = { 'level': level, 'event': event }
+		record.update(fields)
+		log_lines(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+# Log query with number of hits, first hit and time used. Full response is only logged at debug level.
+
+def log_query (backend, method, query, response, hits, first_hit, start_time):
+
+	log ("info", "query", backend=backend, method=method, query=query, hit=(hits > 0), hits=hits, first=first_hit,
+			latency_ms=round((time.time() - start_time) * 1000, 1))
+	log ("debug", "response", backend=backend, method=method, query=query, response=response)
+
+
+# Get open connection to host from pool, or open a new one. Returns connection and whether it was reused.
+
+def http_connection (scheme, host):
+
+	with http_lock:
+		if http_pool.get((scheme, host)):
+			return (http_pool[ (scheme, host) ].pop(), True)
+
+	if scheme == "http":
+		return (http.client.HTTPConnection(host, timeout=http_timeout), False)
+	else:
+		return (http.client.HTTPSConnection(host, timeout=http_timeout), False)
+
+
+# Query url using a kept-alive connection to the host, and follow redirects. Returns the response body.
+# Raises the same errors as urllib.request.urlopen.
+
+def http_request (url, redirects=0):
+
+	url_parts = urllib.parse.urlsplit(url)
+	path = url_parts.path
+	if url_parts.query:
+		path += "?" + url_parts.query
+
+	request_header = dict(header)
+	if http_gzip:
+		request_header['Accept-Encoding'] = "gzip"
+
+	# Connections through a proxy are left to urllib
+
+	if (url_parts.scheme in http_proxies) and not(urllib.request.proxy_bypass(url_parts.hostname)):
+		response = urllib.request.urlopen(urllib.request.Request(url, headers=request_header), timeout=http_timeout)
+		body = response.read()
+		if response.headers.get("Content-Encoding", "").lower() == "gzip":
+			body = gzip.decompress(body)
+		return body
+
+	while True:
+		connection, reused = http_connection(url_parts.scheme, url_parts.netloc)
+		try:
+			connection.request("GET", path, headers=request_header)
+			response = connection.getresponse()
+			body = response.read()
+			break
+
+		except (http.client.HTTPException, OSError) as e:
+			connection.close()
+			if not(reused):
+				raise urllib.error.URLError(e)
+			# Kept-alive connection was closed by the server, so try again with a new connection
+
+	if response.will_close:
+		connection.close()
+	else:
+		with http_lock:
+			http_pool.setdefault((url_parts.scheme, url_parts.netloc), []).append(connection)
+
+	if (response.status in [301, 302, 303, 307, 308]) and response.getheader("Location") and (redirects < max_redirects):
+		return http_request(urllib.parse.urljoin(url, response.getheader("Location")), redirects + 1)
+
+	if response.status != 200:
+		raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+	if response.getheader("Content-Encoding", "").lower() == "gzip":
+		body = gzip.decompress(body)
+
+	return body
+
+
+# Seconds to wait before next attempt: Retry-After from the service, or doubled delay with random jitter
+
+def retry_wait (error, tries):
+
+	retry_after = None
+	if isinstance(error, urllib.error.HTTPError) and error.headers and error.headers.get("Retry-After"):
+		retry_after = error.headers.get("Retry-After").strip()
+		if retry_after.isdigit():
+			retry_after = int(retry_after)
+		else:
+			try:
+				retry_after = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+			except (TypeError, ValueError):
+				retry_after = None
+
+	if retry_after is not None:
+		return max(retry_after, 0)
+	else:
+		delay = min(retry_delay * (2**tries), retry_max_delay)
+		return random.uniform(delay / 2, delay)
+
+
+# Query service, try up to retry_tries times with increasing wait. Returns the response body, decoded if a decode function
+# is given. Raises ServiceError if the query fails, if the response cannot be decoded (which also counts as a failure
+# of the service), or if the service is skipped after earlier failures.
+
+def http_get (url, backend, decode=None):
+
+	breaker = circuit_breakers[ backend ]
+	if not(breaker.allow()):
+		raise ServiceError(backend, "skipped after failed queries")
+
+	tries = 0
+	while True:
+		if backend in rate_limiters:
+			rate_limiters[ backend ].wait(quota_wait)
+
+		try:
+			log_buffer.queried = True  # Not answered from cache
+			body = http_request(url)
+			if decode:
+				body = decode(body)
+			breaker.success()
+			return body
+
+		except (ValueError, KeyError, TypeError, IndexError, AttributeError) as e:  # For example a maintenance page instead of JSON
+			breaker.failure()
+			raise ServiceError(backend, "unexpected response (%s: %s) - %s" % (type(e).__name__, e, url))
+
+		except urllib.error.HTTPError as e:
+			if e.code not in [429, 500, 502, 503, 504]:  # Not "Too many requests", "Service unavailable", "Gateway timed out" etc.
+				raise ServiceError(backend, "HTTP error %i: %s - %s" % (e.code, e.reason, url))
+			error = e
+			reason = "HTTP error %i: %s" % (e.code, e.reason)
+
+		except urllib.error.URLError as e:  # Mostly "Connection reset by peer"
+			error = e
+			reason = str(e.reason)
+
+		tries += 1
+		wait = retry_wait(error, tries - 1)
+
+		if (tries >= retry_tries) or (wait > retry_max_delay):
+			breaker.failure(pause=wait if wait > retry_max_delay else 0)  # Service asked for a long wait
+			raise ServiceError(backend, "%s - %s" % (reason, url))
+
+		message ("\r\tRetry %i in %is... " % (tries, wait))
+		time.sleep(wait)
+
+
+# Log failed query, and note the failure for the address being geocoded in the current thread
+
+def query_failed (error):
+
+	log ("warning", "query_failed", backend=error.backend, error=str(error))
+	failures = getattr(log_buffer, "failures", None)
+	if failures is not None:
+		failures.add(error.backend)
+
+
+# Empty counters of calls, hits and time used for a strategy step and method.
+# Calls answered by a service are kept apart from calls answered from cache or local registers.
+
+def new_strategy_stats():
+
+	return { 'hits': 0, 'network': [], 'cached': [] }
+
+
+# Count calls, hits and time used for strategy step and method
+
+def record_strategy (step, backend, method, hit, queried, latency):
+
+	with count_lock:
+		if (step, backend, method) not in strategy_stats:
+			strategy_stats[ (step, backend, method) ] = new_strategy_stats()
+		stats = strategy_stats[ (step, backend, method) ]
+		if hit:
+			stats['hits'] += 1
+		if queried:
+			stats['network'].append(latency)
+		else:
+			stats['cached'].append(latency)
+
+
+# Decorator for search functions with method as last parameter, to record calls, hits and time used for each method.
+# The step of the strategy is given as keyword parameter.
+
+def instrumented (backend):
+
+	def decorator (search_function):
+
+		@functools.wraps(search_function)
+		def wrapper (*parameters, step=None):
+			start_time = time.time()
+			log_buffer.queried = False
+			result = search_function(*parameters)
+			record_strategy(step, backend, parameters[-1], result is not None, log_buffer.queried, time.time() - start_time)
+			return result
+
+		return wrapper
+
+	return decorator
+
+
+# Percentile of sorted list of values (nearest rank)
+
+def percentile (values, fraction):
+
+	if values:
+		return values[ max(math.ceil(fraction * len(values)) - 1, 0) ]
+	else:
+		return 0
+
+
+# Save report with calls, hits and time used for each step and method of the strategies, as JSON and CSV files.
+# Time used is given for calls answered by the service, and in total for calls answered from cache or local registers.
+
+def save_stats_report (json_filename, csv_filename):
+
+	report = []
+	for (step, backend, method), stats in sorted(strategy_stats.items(), key=lambda item: (item[0][0] or 0, item[0][1], item[0][2])):
+		calls = len(stats['network']) + len(stats['cached'])
+		latencies = sorted(stats['network'])
+		report.append({
+			'step': step,
+			'backend': backend,
+			'method': method,
+			'calls': calls,
+			'queries': len(stats['network']),
+			'cached': len(stats['cached']),
+			'hits': stats['hits'],
+			'hit_rate': round(stats['hits'] / calls, 3),
+			'queries_per_hit': round(calls / stats['hits'], 1) if stats['hits'] else None,
+			'total_ms': round(sum(latencies) * 1000, 1),
+			'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+			'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+			'cached_ms': round(sum(stats['cached']) * 1000, 1)
+		})
+
+	file = open(json_filename, "w", encoding="utf-8")
+	json.dump({ 'tried': tried_count, 'geocoded': geocode_count, 'failed': failed_count, 'hits': hits, 'methods': report },
+				file, indent=1, ensure_ascii=False)
+	file.close()
+
+	file = open(csv_filename, "w", encoding="utf-8", newline="")
+	columns = ['step', 'backend', 'method', 'calls', 'queries', 'cached', 'hits', 'hit_rate', 'queries_per_hit',
+				'total_ms', 'p50_ms', 'p95_ms', 'cached_ms']
+	writer = csv.DictWriter(file, fieldnames=columns)
+	writer.writeheader()
+	writer.writerows(report)
+	file.close()
+
+
+# Open persistent cache of query responses and remove expired entries
+
+def open_cache():
+
+	global cache_db, cache_stored
+
+	cache_db = None
+	cache_stored = 0
+
+	if not(query_cache):
+		return
+
+	if cache_readonly:
+		if not(os.path.isfile(cache_filename)):
+			message ("Cache file '%s' not found\n" % cache_filename)
+			return
+		cache_db = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(cache_filename), uri=True, check_same_thread=False)
+
+	else:
+		cache_db = sqlite3.connect(cache_filename, timeout=60, check_same_thread=False)  # Wait for other processes
+		cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, backend TEXT, response TEXT, created REAL)")
+		cache_db.execute("DELETE FROM responses WHERE created < ?", (time.time() - cache_ttl * 24 * 60 * 60,))
+		cache_db.commit()
+
+
+# Close cache and save remaining new responses
+
+def close_cache():
+
+	global cache_db
+
+	with cache_lock:
+		if cache_db:
+			if not(cache_readonly):
+				cache_db.commit()
+			cache_db.close()
+			cache_db = None
+
+
+# Normalize url into cache key: endpoint + sorted query parameters, case and spacing ignored
+
+def cache_key (url):
+
+	url_parts = urllib.parse.urlsplit(url)
+	parameters = urllib.parse.parse_qsl(url_parts.query, keep_blank_values=True)
+	parameters = sorted((key, " ".join(value.lower().split())) for key, value in parameters)
+
+	return url_parts.netloc.lower() + url_parts.path.rstrip("/") + "?" + urllib.parse.urlencode(parameters)
+
+
+# Look up cached response for url, first among queries in this run, then in persistent cache.
+# Returns None if not cached or expired.
+
+def cache_lookup (url):
+
+	global cache_count, memo_count
+
+	key = cache_key(url)
+
+	with cache_lock:
+		if key in query_memo:
+			memo_count += 1
+			query_memo.move_to_end(key)
+			return query_memo[key]
+
+		if not(cache_db):
+			return None
+
+		row = cache_db.execute("SELECT response FROM responses WHERE key = ? AND created >= ?",
+								(key, time.time() - cache_ttl * 24 * 60 * 60)).fetchone()
+		if row:
+			cache_count += 1
+			result = json.loads(row[0])
+			remember_response(key, result)
+			return result
+		else:
+			return None
+
+
+# Keep response in memory during the run. Called with cache lock.
+
+def remember_response (key, result):
+
+	query_memo[key] = result
+	query_memo.move_to_end(key)
+	if len(query_memo) > memo_size:
+		query_memo.popitem(last=False)
+
+
+# Save response for url in cache
+
+def cache_store (url, backend, result):
+
+	global cache_stored
+
+	key = cache_key(url)
+
+	with cache_lock:
+		remember_response(key, result)
+
+		if cache_db and not(cache_readonly):
+			cache_db.execute("INSERT OR REPLACE INTO responses (key, backend, response, created) VALUES (?, ?, ?, ?)",
+								(key, backend, json.dumps(result, separators=(",", ":")), time.time()))
+			cache_stored += 1
+			if cache_stored % cache_commit == 0:
+				cache_db.commit()  # Keep responses if the run is interrupted
+
+
+# Decode JSON response from service, and check that the response has the fields used for each hit.
+# Raises ValueError, KeyError or TypeError if not.
+
+def decode_response (body, backend):
+
+	result = json.loads(body)
+
+	if (backend in ["matrikkel", "ssr"]) and not(isinstance(result, dict)):
+		raise TypeError("response is not an object")
+
+	if backend == "nominatim":
+		hits = result
+	elif backend == "matrikkel":
+		hits = result['adresser']
+	elif backend == "ssr":
+		hits = result.get('stedsnavn', [])
+		if isinstance(hits, dict):  # Single result is not in a list
+			hits = [ hits ]
+	else:
+		return result
+
+	if not(isinstance(hits, list)):
+		raise TypeError("hits are not in a list")
+	for hit in hits:
+		for field in response_fields[ backend ]:
+			hit[ field ]
+
+	return result
+
+
+# Count query answered by service. Responses from cache are not counted.
+
+def count_query (backend):
+
+	global nominatim_count, matrikkel_count, ssr_count
+
+	with count_lock:
+		if backend == "nominatim":
+			nominatim_count += 1
+		elif backend == "matrikkel":
+			matrikkel_count += 1
+		elif backend == "ssr":
+			ssr_count += 1
+
+
+# Load json from service, using cached response if available. Raises ServiceError if the query fails
+# or if the response is not as expected.
+
+def query_service (url, backend):
+
+	result = cache_lookup(url)
+
+	if result is None:
+		result = http_get(url, backend, functools.partial(decode_response, backend=backend))
+		count_query(backend)
+		cache_store(url, backend, result)
+
+	return result
+
+
+# Concatenate address line
+
+def get_address(street, house_number, postal_code, city):
+
+	address = street
+	if house_number:
+		address = address + " " + house_number  # Includes letter
+	if address:
+		address = address + ", "
+	if postal_code:
+		address = address + postal_code + " "
+	if city:
+		address = address + city
+
+	return address.strip()
+
+
+# Geocoding with Nominatim
+
+@instrumented("nominatim")
+def nominatim_search (query_type, query_text, query_municipality, quality, method):
+
+	try:
+		bbox = get_municipality_data(query_municipality)
+	except ServiceError as error:
+		query_failed(error)
+		return None
+
+	url = "https://nominatim.openstreetmap.org/search?%s=%s&countrycodes=no&viewbox=%f,%f,%f,%f&format=json&limit=10" \
+							% (query_type, urllib.parse.quote(query_text),
+								bbox['longitude_min'], bbox['latitude_min'], bbox['longitude_max'], bbox['latitude_max'])
+
+	start_time = time.time()
+	result = cache_lookup(url)
+
+	if result is None:
+
+		if nominatim_deferred:
+			raise NominatimDeferred
+
+		# Only one Nominatim query at a time, also with several worker threads
+		with nominatim_lock:
+
+			if (rate_limiters['nominatim'].total_calls() >= max_nominatim) and not(pause_nominatim):
+				raise NominatimLimitReached
+
+			# Usage policy for Nominatim queries per second and per hour is observed for each attempt
+			try:
+				result = http_get(url, "nominatim", functools.partial(decode_response, backend="nominatim"))
+			except ServiceError as error:
+				query_failed(error)
+				return None
+
+		count_query("nominatim")
+		cache_store(url, "nominatim", result)
+
+	log_query ("nominatim", method, "%s=%s" % (query_type, query_text), result, len(result),
+				"%s/%s" % (result[0]['class'], result[0]['type']) if result else None, start_time)
+
+	if result:
+		if (result[0]['class'] != "boundary") or (result[0]['type'] != "administrative"):  # Skip administrative boundaries (municipalities)
+			result = result[0]
+		elif len(result) > 1:
+			result = result[1]
+		else:
+			return None
+
+		# Check if coordinates are within the bounding box of the municipality
+
+		latitude = float(result['lat'])
+		longitude = float(result['lon'])
+
+		if (latitude > bbox['latitude_min']) and (latitude < bbox['latitude_max']) and \
+			(longitude > bbox['longitude_min']) and (longitude < bbox['longitude_max']):
+			result_type = "Nominatim/%s -> %s/%s" % (method, result['class'], result['type'])
+			if result['class'] == "highway":
+				result_quality = "street"
+			else:
+				result_quality = quality
+			return (result['lat'], result['lon'], result_type, result_quality)
+		else:
+			log ("info", "outside_municipality", backend="nominatim", method=method, municipality=query_municipality)
+			return None
+
+	else:
+		return None
+
+
+# Normalize street or place name for lookup in local registers
+
+def normalize_name (name):
+
+	return " ".join(name.replace("(","").replace(")","").replace(":","").lower().split())
+
+
+# Load post code districts from Posten and save parsed register to file.
+# Returns dict of post code districts, with each row as [city, municipality ref, municipality name, type].
+
+def download_post_districts():
+
+	post_url = 'https://www.bring.no/postnummerregister-ansi.txt'
+	data = http_request(post_url).decode("windows-1252")
+	postal_codes = csv.reader(data.splitlines(), delimiter="\t")
+
+	register = {}
+	for row in postal_codes:
+		if len(row) >= 5:
+			register[ row[0] ] = row[1:5]  # City, municipality ref, municipality name, type (G, P or B)
+
+	file = open(post_filename, "w", encoding="utf-8")
+	json.dump(register, file, ensure_ascii=False, separators=(",", ":"))
+	file.close()
+
+	return register
+
+
+# Load post code districts, from saved register if it is recent, or else from Posten.
+# Builds post_districts by post code and post_cities with the general post codes of each city.
+
+def load_post_districts():
+
+	global post_districts, post_cities
+
+	register = None
+
+	if os.path.isfile(post_filename) and not(refresh_registers) and \
+			(time.time() - os.path.getmtime(post_filename) < post_refresh * 24 * 60 * 60):
+		file = open(post_filename, encoding="utf-8")
+		register = json.load(file)
+		file.close()
+
+	if register is None:
+		try:
+			register = download_post_districts()
+		except (urllib.error.URLError, OSError) as e:
+			if not(os.path.isfile(post_filename)):
+				message ("\n\nPostal code register not available: %s\n" % e)
+				sys.exit()
+			message ("\nUsing saved postal code register, Posten not available: %s\n" % e)
+			file = open(post_filename, encoding="utf-8")
+			register = json.load(file)
+			file.close()
+
+	post_districts = {}
+	post_cities = {}
+
+	for post_code, (city, municipality_ref, municipality_name, post_type) in register.items():
+		post_districts[ post_code ] = {
+			'city': city,
+			'municipality_ref': municipality_ref,
+			'municipality_name': municipality_name,
+			'type': post_type,  # G, P or B
+			'multiple': False
+		}
+		if post_type == "G":
+			post_cities.setdefault(city, []).append(post_code)
+
+	# Discover multiple post code districts for the same city name
+	for post_codes in post_cities.values():
+		if len(post_codes) > 1:
+			for post_code in post_codes:
+				post_districts[ post_code ]['multiple'] = True
+
+
+# Load SSR name types from navnetyper.json, or from Github if refresh is requested.
+# Builds set of all name types, and set of name types in the accepted main groups.
+
+def load_ssr_types():
+
+	global ssr_types, ssr_group_types, ssr_accepted_types
+
+	name_codes = None
+
+	# Refreshed name types are kept apart from the name types distributed with the program
+
+	if os.path.isfile(ssr_types_refreshed_filename):
+		local_filename = ssr_types_refreshed_filename
+	else:
+		local_filename = ssr_types_filename
+
+	if refresh_registers or not(os.path.isfile(local_filename)):
+		try:
+			ssr_url = 'https://raw.githubusercontent.com/osmno/geocode2osm/master/navnetyper.json'
+			data = http_request(ssr_url)
+			name_codes = json.loads(data)
+
+			file = open(ssr_types_refreshed_filename, "wb")
+			file.write(data)
+			file.close()
+
+		except (urllib.error.URLError, OSError, ValueError) as e:
+			if not(os.path.isfile(local_filename)):
+				message ("\n\nSSR name types not available: %s\n" % e)
+				sys.exit()
+			name_codes = None
+
+	if name_codes is None:
+		file = open(local_filename, encoding="utf-8")
+		name_codes = json.load(file)
+		file.close()
+
+	group_types = {}
+	for main_group in name_codes['navnetypeHovedgrupper']:
+		for group in main_group['navnetypeGrupper']:
+			for name_type in group['navnetyper']:
+				group_types.setdefault(main_group['navn'], set()).add(name_type['visningsnavn'].strip().lower())
+
+	ssr_group_types = { main_group: frozenset(name_types) for main_group, name_types in group_types.items() }
+	ssr_accepted_types = frozenset().union(*[ ssr_group_types.get(main_group, frozenset()) for main_group in ssr_groups ])
+	ssr_types = frozenset().union(*ssr_group_types.values())
+
+
+# Load SSR name types if not already loaded
+
+def require_ssr_types():
+
+	with ssr_types_lock:
+		if ssr_types is None:
+			load_ssr_types()
+
+
+# Open semicolon separated CSV extract, possibly inside a zip file.
+# Returns file, csv reader and dict of column positions by lower case column name without punctuation ("EPSG-kode" is "epsgkode").
+
+def open_extract (extract_filename, required_columns):
+
+	if extract_filename.lower().endswith(".zip"):
+		archive = zipfile.ZipFile(extract_filename)
+		csv_name = [ name for name in archive.namelist() if name.lower().endswith(".csv") ][0]
+		file = TextIOWrapper(archive.open(csv_name), "utf-8-sig")
+	else:
+		file = open(extract_filename, encoding="utf-8-sig")
+
+	rows = csv.reader(file, delimiter=";")
+	columns = { re.sub(r"[\W_]", "", name.lower()): i for i, name in enumerate(next(rows)) }
+
+	for column in required_columns:
+		if column not in columns:
+			message ("\n\nColumn '%s' not found in '%s'\n" % (column, extract_filename))
+			sys.exit()
+
+	return (file, rows, columns)
+
+
+# Build indexed database from address register extract (CSV file in EPSG:4258 from Kartverket "Matrikkelen - Adresse").
+# Columns are identified by name, for example "adressenavn", "nummer", "bokstav", "postnummer", "poststed", "Nord", "Øst".
+
+def build_matrikkel_register (extract_filename, database_filename):
+
+	message ("\nBuilding address register from '%s'... " % extract_filename)
+
+	file, addresses, columns = open_extract(extract_filename,
+									['adressenavn', 'nummer', 'bokstav', 'postnummer', 'poststed', 'kommunenummer', 'nord', 'øst'])
+
+	if os.path.isfile(database_filename):
+		os.remove(database_filename)
+
+	database = sqlite3.connect(database_filename)
+	database.execute("CREATE TABLE adresser (street TEXT, number TEXT, letter TEXT, postcode TEXT, city TEXT, " + \
+						"municipality_ref TEXT, objtype TEXT, latitude REAL, longitude REAL)")
+
+	count = 0
+	batch = []
+	for row in addresses:
+		latitude = float(row[ columns['nord'] ])
+		longitude = float(row[ columns['øst'] ])
+
+		# Coordinates must be latitude and longitude within Norway, not for example UTM
+		if ("epsgkode" in columns and row[ columns['epsgkode'] ] not in ["", "4258", "4326"]) or \
+				not(57 <= latitude <= 82) or not(-10 <= longitude <= 35):
+			message ("\n\nAddress register must have EPSG:4258 coordinates within Norway, not %s, %s (EPSG:%s)\n"
+						% (row[ columns['nord'] ], row[ columns['øst'] ], row[ columns['epsgkode'] ] if "epsgkode" in columns else "unknown"))
+			file.close()
+			database.close()
+			os.remove(database_filename)
+			sys.exit()
+
+		if "adressetype" in columns and row[ columns['adressetype'] ]:
+			objtype = row[ columns['adressetype'] ][0].upper() + row[ columns['adressetype'] ][1:]
+		else:
+			objtype = "Vegadresse"
+
+		batch.append((normalize_name(row[ columns['adressenavn'] ]), row[ columns['nummer'] ], row[ columns['bokstav'] ].upper(),
+						row[ columns['postnummer'] ], row[ columns['poststed'] ].upper(), row[ columns['kommunenummer'] ], objtype,
+						latitude, longitude))
+
+		if len(batch) == 10000:
+			database.executemany("INSERT INTO adresser VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+			count += len(batch)
+			batch = []
+
+	database.executemany("INSERT INTO adresser VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+	count += len(batch)
+	file.close()
+
+	database.execute("CREATE INDEX address_index ON adresser (street, number, letter, postcode)")
+	database.execute("CREATE INDEX municipality_index ON adresser (street, municipality_ref)")
+	database.commit()
+	database.close()
+
+	message ("%i addresses\n" % count)
+
+
+# Open local address register, and build it first if the extract is new
+
+def open_matrikkel_register():
+
+	global matrikkel_db
+
+	matrikkel_db = None
+
+	if matrikkel_extract:
+		database_filename = os.path.splitext(matrikkel_extract)[0] + ".db"
+		if not(os.path.isfile(database_filename)) or (os.path.getmtime(database_filename) < os.path.getmtime(matrikkel_extract)):
+			build_matrikkel_register(matrikkel_extract, database_filename)
+
+		matrikkel_db = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(database_filename), uri=True, check_same_thread=False)
+
+
+# Look up address in local address register. Same parameters and result format as the Matrikkel service.
+
+def local_matrikkel_search (street, house_number, house_letter, post_code, city, municipality_ref):
+
+	conditions = ["street = ?"]
+	parameters = [ normalize_name(street) ]
+
+	if house_number:
+		conditions.append("number = ?")
+		parameters.append(house_number)
+	if house_letter:
+		conditions.append("letter = ?")
+		parameters.append(house_letter.upper())
+	if post_code and not(municipality_ref):
+		conditions.append("postcode = ?")
+		parameters.append(post_code)
+	if city and not(municipality_ref):
+		conditions.append("city = ?")
+		parameters.append(city.upper())
+	if municipality_ref:
+		conditions.append("municipality_ref = ?")
+		parameters.append(municipality_ref)
+
+	with register_lock:
+		rows = matrikkel_db.execute("SELECT objtype, latitude, longitude FROM adresser WHERE " + " AND ".join(conditions) + \
+									" ORDER BY CAST(number AS INTEGER), letter LIMIT 10", parameters).fetchall()
+
+	return [ { 'objtype': objtype, 'representasjonspunkt': { 'lat': latitude, 'lon': longitude } } for objtype, latitude, longitude in rows ]
+
+
+# Geocoding with Matrikkel Vegadresse
+
+@instrumented("matrikkel")
+def matrikkel_search (street, house_number, house_letter, post_code, city, municipality_ref, quality, method):
+
+	global variant_query_count
+
+	# Build query string. Use municipality instead of postcode/city if available
+	query = ""
+	if street:
+		query += "sok=%s" % urllib.parse.quote(street.replace("(","").replace(")","").replace(":",""))
+	if house_number:
+		query += "&nummer=%s" % house_number
+	if house_letter:
+		query += "&bokstav=%s" % house_letter
+	if post_code and not(municipality_ref):
+		query += "&postnummer=%s" % post_code
+	if city and not(municipality_ref):
+		query += "&poststed=%s" % urllib.parse.quote(city)
+	if municipality_ref:
+		query += "&kommunenummer=%s" % municipality_ref
+
+	start_time = time.time()
+	if matrikkel_db:
+		result = local_matrikkel_search(street, house_number, house_letter, post_code, city, municipality_ref)
+	else:
+		url = "https://ws.geonorge.no/adresser/v1/sok?" + query + "&treffPerSide=10"
+		try:
+			result = query_service(url, "matrikkel")
+		except ServiceError as error:
+			query_failed(error)
+			return None
+		result = result['adresser']
+
+	log_query ("matrikkel", method, urllib.parse.unquote(query), result, len(result), result[0]['objtype'] if result else None, start_time)
+	with count_lock:
+		if method in ["address+synonymfix", "address+genitivefix"]:
+			variant_query_count += 1
+
+	if result:
+		result_type = "Matrikkel/%s -> %s" % (method, result[0]['objtype'])
+		latitude = result[0]['representasjonspunkt']['lat']
+		longitude = result[0]['representasjonspunkt']['lon']
+		return (str(latitude), str(longitude), result_type, quality)
+	else:
+		return None
+
+
+# Build indexed database from SSR place name extract (CSV file in EPSG:4258 with columns
+# "stedsnavn", "navnetype", "kommunenummer", "Nord" and "Øst", for example converted from the GML/PostGIS dataset).
+# Only name types within the accepted main groups are included.
+
+def build_ssr_register (extract_filename, database_filename):
+
+	message ("\nBuilding place name register from '%s'... " % extract_filename)
+
+	require_ssr_types()
+	file, places, columns = open_extract(extract_filename, ['stedsnavn', 'navnetype', 'kommunenummer', 'nord', 'øst'])
+
+	if os.path.isfile(database_filename):
+		os.remove(database_filename)
+
+	database = sqlite3.connect(database_filename)
+	database.execute("CREATE TABLE stedsnavn (municipality_ref TEXT, name TEXT, stedsnavn TEXT, navnetype TEXT, latitude REAL, longitude REAL)")
+
+	count = 0
+	not_found = set()
+	batch = []
+	for row in places:
+		name_type = row[ columns['navnetype'] ].strip()
+		if name_type.lower() not in ssr_types:
+			not_found.add(name_type)
+		elif name_type.lower() in ssr_accepted_types:
+			batch.append((row[ columns['kommunenummer'] ], normalize_name(row[ columns['stedsnavn'] ]), row[ columns['stedsnavn'] ],
+							name_type, float(row[ columns['nord'] ]), float(row[ columns['øst'] ])))
+
+		if len(batch) == 10000:
+			database.executemany("INSERT INTO stedsnavn VALUES (?, ?, ?, ?, ?, ?)", batch)
+			count += len(batch)
+			batch = []
+
+	database.executemany("INSERT INTO stedsnavn VALUES (?, ?, ?, ?, ?, ?)", batch)
+	count += len(batch)
+	file.close()
+
+	database.execute("CREATE INDEX name_index ON stedsnavn (municipality_ref, name)")
+	database.commit()
+	database.close()
+
+	message ("%i place names\n" % count)
+	if not_found:
+		message ("SSR name types not found: %s - please post issue at 'https://github.com/osmno/geocode2osm'\n" % str(sorted(not_found)))
+
+
+# Open local place name register, and build it first if the extract is new
+
+def open_ssr_register():
+
+	global ssr_db
+
+	ssr_db = None
+
+	if ssr_extract:
+		database_filename = os.path.splitext(ssr_extract)[0] + ".db"
+		if not(os.path.isfile(database_filename)) or (os.path.getmtime(database_filename) < os.path.getmtime(ssr_extract)):
+			build_ssr_register(ssr_extract, database_filename)
+
+		ssr_db = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(database_filename), uri=True, check_same_thread=False)
+
+
+# Look up place name in local place name register. Exact matches first, then names starting with the query.
+# Same result format as the SSR service.
+
+def local_ssr_search (query_text, query_municipality):
+
+	name = normalize_name(query_text)
+
+	with register_lock:
+		rows = ssr_db.execute("SELECT stedsnavn, navnetype, latitude, longitude FROM stedsnavn " + \
+								"WHERE municipality_ref = ? AND name >= ? AND name < ? ORDER BY name != ?, name LIMIT 25",
+								(query_municipality, name, name + "\uffff", name)).fetchall()
+
+	return { 'stedsnavn': [ { 'stedsnavn': place_name, 'navnetype': name_type, 'nord': str(latitude), 'aust': str(longitude) }
+							for place_name, name_type, latitude, longitude in rows ] }
+
+
+# Geocoding with SSR
+
+@instrumented("ssr")
+def ssr_search (query_text, query_municipality, quality, method):
+
+	global ssr_not_found
+
+	require_ssr_types()
+
+	start_time = time.time()
+	if ssr_db:
+		result = local_ssr_search(query_text, query_municipality)
+	else:
+		query = "https://ws.geonorge.no/SKWS3Index/ssr/json/sok?navn=%s&epsgKode=4326&fylkeKommuneListe=%s&eksakteForst=true" \
+					% (urllib.parse.quote(query_text.replace("(","").replace(")","")), query_municipality)
+		try:
+			result = query_service(query, "ssr")
+		except ServiceError as error:
+			query_failed(error)
+			return None
+
+	# Response may be shared with other threads through the memo, so it is not modified
+	places = result.get('stedsnavn', [])
+	if isinstance(places, dict):  # Single result is not in a list
+		places = [ places ]
+
+	log_query ("ssr", method, "%s, municipality #%s" % (query_text, query_municipality), result, len(places),
+				places[0]['navnetype'] if places else None, start_time)
+
+	if places:
+
+		# Check if name type is defined in category table
+		for place in places:
+			if not(place['navnetype'].lower().strip() in ssr_types):
+				message ("\n\t**** SSR name type '%s' not found - please post issue at 'https://github.com/osmno/geocode2osm' ****\n\n"\
+							% place['navnetype'])
+				log ("warning", "ssr_type_not_found", name_type=place['navnetype'])
+				with count_lock:
+					if not(place['navnetype'] in ssr_not_found):
+						ssr_not_found.append(place['navnetype'])
+
+		# Return the first acceptable result
+		for place in places:
+			if place['navnetype'].lower().strip() in ssr_accepted_types:
+				result_type = "SSR/%s -> %s" % (method, place['navnetype'].strip())
+				return (place['nord'], place['aust'], result_type, quality)
+	
+	return None
+
+
+# Load bounding box for given municipality ref from kommuneinfo
+
+def load_municipality_bbox (query_municipality):
+
+	query = "https://ws.geonorge.no/kommuneinfo/v1/kommuner/%s" % query_municipality
+	return http_get(query, "kommuneinfo", decode_municipality_bbox)
+
+
+# Decode bounding box from kommuneinfo response. Raises ValueError, KeyError or TypeError if not as expected.
+
+def decode_municipality_bbox (body):
+
+	bbox = {
+		'latitude_min': 90.0,
+		'latitude_max': -90.0,
+		'longitude_min': 180.0,
+		'longitude_max': -180.0
+		}
+
+	for node in json.loads(body)['avgrensningsboks']['coordinates'][0][1:]:
+		bbox['latitude_max'] = max(bbox['latitude_max'], float(node[1]))
+		bbox['latitude_min'] = min(bbox['latitude_min'], float(node[1]))
+		bbox['longitude_max'] = max(bbox['longitude_max'], float(node[0]))
+		bbox['longitude_min'] = min(bbox['longitude_min'], float(node[0]))
+
+	return bbox
+
+
+# Get bounding box for given municipality ref from bounding box table, or load it if missing
+
+def get_municipality_data (query_municipality):
+
+	global municipality_bbox_updated
+
+	if query_municipality and (query_municipality != "2100"):  # Exclude Svalbard
+		with bbox_lock:
+			if query_municipality not in municipality_bbox:
+				bbox = load_municipality_bbox(query_municipality)
+				municipality_bbox[ query_municipality ] = bbox
+				municipality_bbox_updated = True
+
+				log ("info", "municipality_bbox", municipality=query_municipality, bbox=bbox)
+
+			return municipality_bbox[ query_municipality ]
+
+	else:
+		return {
+			'latitude_min': -90.0,
+			'latitude_max': 90.0,
+			'longitude_min': -180.0,
+			'longitude_max': 180.0
+			}
+
+
+# Read table of municipality bounding boxes from file, if available
+
+def read_municipality_bbox():
+
+	global municipality_bbox, municipality_bbox_updated
+
+	municipality_bbox = {}
+	municipality_bbox_updated = False
+
+	if os.path.isfile(bbox_filename):
+		file = open(bbox_filename)
+		municipality_bbox = json.load(file)
+		file.close()
+
+
+# Save table of municipality bounding boxes if new municipalities were loaded during the run
+
+def save_municipality_bbox():
+
+	global municipality_bbox_updated
+
+	if municipality_bbox_updated:
+		file = open(bbox_filename, "w")
+		json.dump(municipality_bbox, file, indent=1, sort_keys=True)
+		file.close()
+		municipality_bbox_updated = False
+
+
+# Load bounding boxes for all municipalities into the table, for offline use
+
+def download_municipality_bbox():
+
+	global municipality_bbox_updated
+
+	try:
+		municipalities = http_get("https://ws.geonorge.no/kommuneinfo/v1/kommuner", "kommuneinfo",
+									lambda body: [ municipality['kommunenummer'] for municipality in json.loads(body) ])
+	except ServiceError as error:
+		message ("\nCould not load municipalities: %s\n" % error)
+		return
+
+	for municipality_ref in municipalities:
+		if municipality_ref != "2100":
+			message ("\rLoading bounding box for municipality #%s... " % municipality_ref)
+			try:
+				municipality_bbox[ municipality_ref ] = load_municipality_bbox(municipality_ref)
+			except ServiceError as error:
+				message ("\n\tCould not load bounding box: %s\n" % error)
+
+	municipality_bbox_updated = True
+	save_municipality_bbox()
+	message ("\rLoaded bounding boxes for %i municipalities\n" % len(municipality_bbox))
+
+
+# Compile synonym table once. For each synonym group: pattern to detect if any of the words are present,
+# the words to test (abbreviations with and without period) and whether to test genitive variations.
+
+def compile_synonyms():
+
+	table = []
+
+	for synonyms in street_synonyms:
+		words = []
+		for synonym_word in synonyms:
+			if "." in synonym_word:
+				words.append((synonym_word, [synonym_word, synonym_word[:-1]]))  # Abreviation with and without period
+			else:
+				words.append((synonym_word, [synonym_word]))
+
+		pattern = re.compile("|".join(re.escape(test_word + " ") for synonym_word, test_list in words for test_word in test_list))
+		table.append((pattern, synonyms, words, not("sen" in synonyms)))
+
+	return table
+
+
+synonym_table = compile_synonyms()
+
+
+# Generate street name variations with synonyms and genitive variations, in the order they should be tested.
+# Variations which are identical to the street name or to earlier variations are skipped.
+
+@functools.lru_cache(maxsize=10000)
+def synonym_variants (street):
+
+	low_street = street.lower() + " "
+	variants = []
+	tested = set([ " ".join(low_street.split()) ])
+
+	# Iterate synonym groups present in street name (twice for abbreviations)
+
+	for pattern, synonyms, words, test_genitive in synonym_table:
+		if not(pattern.search(low_street)):
+			continue
+
+		for synonym_word, test_list in words:
+			found = False
+
+			for test_word in test_list:
+
+				# Test synonyms, including abbreviations
+
+				found_position = low_street.rfind(test_word + " ")
+				if found_position >= 0:
+					found = True
+
+					for synonym_replacement in synonyms:
+						candidates = []
+
+						if (synonym_replacement != synonym_word) and not("." in synonym_replacement):
+							new_street = low_street[0:found_position] + low_street[found_position:].replace(test_word, synonym_replacement)
+							candidates.append((new_street, "address+synonymfix"))
+
+						# Test genitive variations
+
+						if (found_position > 1) and test_genitive:
+							for genitive_test in genitive_tests:
+								if ((low_street[found_position - 1] != " ") or (" " in genitive_test[0])) and\
+									((low_street[found_position - 1] != "s") and (low_street[found_position - 2:found_position] != "s ")\
+										or not("s" in genitive_test[1])):
+
+									new_street = low_street[0:found_position - 2] + \
+										low_street[found_position - 2:].replace(genitive_test[0] + test_word, genitive_test[1] + synonym_replacement)
+									candidates.append((new_street, "address+genitivefix"))
+
+						for new_street, method in candidates:
+							if " ".join(new_street.split()) not in tested:
+								tested.add(" ".join(new_street.split()))
+								variants.append((new_street, method))
+
+			if found:
+				break  # Already match in synonym group, so no need to test rest of the group
+
+	return tuple(variants)
+
+
+# Count street name variants generated for an address. Variants are counted for each address, like the variants queried.
+
+def count_variants (count):
+
+	global variant_count
+
+	with count_lock:
+		variant_count += count
+
+
+# Run search in speculative worker thread. Returns result together with log lines and failed services for the search.
+
+def speculative_task (search_function, search_parameters):
+
+	log_buffer.lines = []
+	log_buffer.failures = set()
+	try:
+		result = search_function(*search_parameters)
+		return (result, "".join(log_buffer.lines), log_buffer.failures)
+	finally:
+		log_buffer.lines = None
+		log_buffer.failures = None
+
+
+# Run candidate searches concurrently and return the result of the first candidate in the list with a match.
+# Candidates after a match are cancelled, so the result is the same as when testing the candidates one by one.
+
+def first_result (candidates):
+
+	tasks = [ speculative_pool.submit(speculative_task, search_function, search_parameters)
+				for search_function, search_parameters in candidates ]
+	best = len(tasks)
+	pending = set(tasks)
+
+	while pending and not all(task.done() for task in tasks[:best]):
+		done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+		for task in done:
+			index = tasks.index(task)
+			if (index < best) and not(task.cancelled()) and task.result()[0]:
+				best = index
+				for later_task in tasks[index + 1:]:
+					later_task.cancel()
+
+	# Tasks may also complete after the last wait
+	for index, task in enumerate(tasks[:best]):
+		if task.result()[0]:
+			best = index
+			for later_task in tasks[index + 1:]:
+				later_task.cancel()
+			break
+
+	for task in tasks[:best + 1]:
+		log_lines (task.result()[1])
+		log_buffer.failures.update(task.result()[2])
+
+	if best < len(tasks):
+		return tasks[best].result()[0]
+	else:
+		return None
+
+
+# Replace other information than street names for better match in Nominatim, in one pass
+
+def fix_names (text):
+
+	text = fix_name_pattern.sub(lambda match: fix_name_replacement[ match.group(0) ] + " ", text)
+	return spaces_pattern.sub(" ", text).strip()
+
+
+# Decompose address into street, house number, letter, postcode and city.
+# Address format: "Skøyen skole, Lørenveien 7, 0585 Oslo" (optional first part)
+
+def split_address (address):
+
+	parts = ParsedAddress()
+	address_split = [ part.strip() for part in address.split(",") ]
+
+	if len(address_split) > 1:
+		street = address_split[-2]
+		parts.postcode = address_split[-1][0:4]
+		parts.city = address_split[-1][5:].strip()
+
+		match = house_range_pattern.search(street) or house_number_pattern.search(street)
+		if match:
+			street = match.group(1).strip()
+			parts.house_number = match.group(2).upper()
+			parts.house_letter = match.group(3)
+
+		parts.street = fix_names(street)
+		parts.street_extra = fix_names(", ".join(address_split[0:-2]))
+
+	else:
+		parts.postcode = address[0:4]
+		parts.city = address[5:].strip()
+
+	return parts
+
+
+# Decompose list of addresses, for example a column of a CSV file. Repeated addresses are only decomposed once.
+
+def split_addresses (addresses):
+
+	parsed = {}
+	for address in addresses:
+		if address not in parsed:
+			parsed[ address ] = split_address(address)
+
+	return [ parsed[ address ] for address in addresses ]
+
+
+# Make address from separate street, house number, postcode and city, for example columns of a CSV file.
+# The address is not decomposed, only names are fixed. Missing leading zeros of postcodes are added.
+
+def fields_address (street, house_number, postcode, city):
+
+	parts = ParsedAddress()
+
+	match = house_field_pattern.match(house_number.strip())
+	if match:
+		parts.house_number = match.group(1)
+		parts.house_letter = match.group(2)
+
+	parts.street = fix_names(street)
+	parts.postcode = postcode.strip().zfill(4) if postcode.strip() else ""
+	parts.city = city.strip()
+
+	return parts
+
+
+# Decompose address, and find municipality and post district name of postcode
+
+def parse_address (address):
+
+	return add_post_district(split_address(address))
+
+
+# Find municipality and post district name of postcode of decomposed address
+
+def add_post_district (parts):
+
+	if parts.postcode in post_districts:
+		post_district = post_districts[ parts.postcode ]
+		parts.municipality_ref = post_district['municipality_ref']
+		parts.municipality_name = post_district['municipality_name']
+		parts.postcode_name = post_district['city']
+		parts.single_district = not(post_district['multiple'])
+	else:
+		log ("warning", "postcode_not_found", postcode=parts.postcode)
+
+	parts.postcode_name_differs = parts.postcode_name != parts.city.upper()
+	parts.municipality_name_differs = parts.municipality_name != parts.city.upper()
+
+	return parts
+
+
+# Geocode address with each strategy in the pipeline until a result is found. The address is either a string
+# or a list of street, house number, postcode and city.
+# Consecutive strategies marked as speculative are tested in parallel in speculative mode.
+
+def geocode_address (address):
+
+	if isinstance(address, str):
+		address_parts = parse_address(address)
+	else:
+		address_parts = add_post_district(fields_address(*address))
+
+	log ("info", "parsed", **{ key: value for key, value in address_parts.as_dict().items() if isinstance(value, str) })
+
+	result = None
+	step = 0
+
+	while not(result) and (step < len(pipeline)):
+
+		if speculative and pipeline[ step ].speculative:
+			candidates = []
+			while (step < len(pipeline)) and pipeline[ step ].speculative:
+				if pipeline[ step ].applies(address_parts):
+					candidates.extend(pipeline[ step ].candidates(address_parts))
+				step += 1
+			if candidates:
+				result = first_result(candidates)
+
+		else:
+			if pipeline[ step ].applies(address_parts):
+				result = pipeline[ step ].run(address_parts)
+			step += 1
+
+	return result
+
+
+# Geocode address in worker thread. Returns result together with log lines for the address,
+# and the services which failed. If a result was found after a failed service, a more precise strategy may have been skipped.
+
+def geocode_task (address):
+
+	log_buffer.lines = []
+	log_buffer.failures = set()
+	try:
+		result = geocode_address(address)
+		return (result, "".join(log_buffer.lines), sorted(log_buffer.failures))
+	finally:
+		log_buffer.lines = None
+		log_buffer.failures = None
+
+
+# Index tag elements of node by key, in one pass over the children. The first tag is used for repeated keys.
+
+def node_tags (node):
+
+	tags = {}
+	for child in node:
+		if child.tag == "tag":
+			tags.setdefault(child.get("k"), child)
+
+	return tags
+
+
+# Set value of tag, or add tag if missing
+
+def set_tag (node, tags, key, value):
+
+	if key in tags:
+		tags[ key ].set("v", value)
+	else:
+		tags[ key ] = ElementTree.SubElement(node, "tag", k=key, v=value)
+
+
+# Remove tag if present
+
+def remove_tag (node, tags, key):
+
+	if key in tags:
+		node.remove(tags.pop(key))
+
+
+# Start geocoding of node in worker thread if it is marked with GEOCODE tag, or use saved result for the node.
+# Returns (task, repeated address), or (None, False) if the node will not be geocoded.
+
+def start_geocoding (node, tags, geocode):
+
+	if ("ADDRESS" in tags) and (tags['GEOCODE'].get("v").lower() not in ["no", "done"]):
+
+		address = tags['ADDRESS'].get("v")
+		task, repeated_address, saved_result = start_address(node.get("id"), address, address, geocode)
+		if saved_result:
+			apply_result(node, tags, saved_result['result'], saved_result['failed'])
+		return (task, repeated_address)
+
+	return (None, False)
+
+
+# Start geocoding of address of node or row in worker thread. The address is used for reporting and for repeated addresses,
+# while the query address is geocoded (the same address, or list of separate address parts).
+# Returns (task, repeated address, saved result), where saved result is from an interrupted run or from deferred addresses
+# if the address is unchanged.
+
+def start_address (object_id, address, query_address, geocode):
+
+	if (object_id in saved_results) and (saved_results[ object_id ]['address'] == address):
+		return (None, False, saved_results[ object_id ])
+
+	if not(geocode):
+		return (None, False, None)
+
+	address_key = " ".join(address.split())
+
+	if address_key in address_memo:
+		return (address_memo[address_key], True, None)
+	else:
+		address_memo[address_key] = pool.submit(geocode_task, query_address)
+		return (address_memo[address_key], False, None)
+
+
+# Update coordinates and tags of node with geocoding result. Nodes which failed because of unavailable services
+# are geocoded again next time, also if a less precise result was found.
+
+def apply_result (node, tags, result, failures):
+
+	# If successful, update coordinates and save geocoding details for information
+
+	if result:
+
+		latitude = result[0]
+		longitude = result[1]
+		result_type = result[2]
+		result_quality = result[3]
+
+		node.set("lat", latitude)
+		node.set("lon", longitude)
+		node.set("action", "modify")
+
+		set_tag(node, tags, "GEOCODE_METHOD", result_type)
+		set_tag(node, tags, "GEOCODE_RESULT", result_quality)
+
+		if failures:
+			return  # Geocode again next time
+
+	elif failures:
+		set_tag(node, tags, "GEOCODE_RESULT", "failed")
+		remove_tag(node, tags, "GEOCODE_METHOD")
+		return  # Geocode again next time
+
+	else:
+		if "GEOCODE_RESULT" in tags:
+			set_tag(node, tags, "GEOCODE_RESULT", "no match")
+		else:
+			set_tag(node, tags, "GEOCODE_RESULT", "not found")
+		remove_tag(node, tags, "GEOCODE_METHOD")
+
+	tags['GEOCODE'].set("v", "done")  # Do not geocode next time
+
+
+# Update node with geocoding result, and save result in journal
+
+def update_node (node, tags, result, address_log, failures, repeated_address):
+
+	apply_result(node, tags, result, failures)
+	report_result(node.get("id"), tags['ADDRESS'].get("v"), result, address_log, failures, repeated_address)
+
+
+# Count, log and save geocoding result in journal
+
+def report_result (node_id, address, result, address_log, failures, repeated_address):
+
+	global tried_count, geocode_count, failed_count, address_memo_count
+
+	tried_count += 1
+	message ("%i %s " % (tried_count, address))	
+	log ("info", "address", number=tried_count, node=node_id, address=address, repeated=repeated_address)
+
+	if repeated_address:
+		address_memo_count += 1
+	else:
+		log_lines (address_log)
+
+	if result and failures:
+		message ("--> %s (%s) - %s not available, geocoded again next time\n" % (result[2], result[3], ", ".join(failures)))
+		log ("warning", "result", number=tried_count, node=node_id, match=True, method=result[2], precision=result[3], failed=failures)
+		failed_count += 1
+	elif result:
+		message ("--> %s (%s)\n" % (result[2], result[3]))
+		log ("info", "result", number=tried_count, node=node_id, match=True, method=result[2], precision=result[3])
+		geocode_count += 1
+		hits[ result[3] ] += 1
+	elif failures:
+		message ("--> FAILED (%s not available)\n" % ", ".join(failures))
+		log ("warning", "result", number=tried_count, node=node_id, match=False, failed=failures)
+		failed_count += 1
+	else:
+		message ("--> NO MATCH\n")
+		log ("info", "result", number=tried_count, node=node_id, match=False)
+
+	write_journal(node_id, address, result, failures)
+
+	# Results are only kept if the output file is written again from the input file
+	if defer_nominatim or (max_processes > 1):
+		saved_results[ node_id ] = { 'address': address, 'result': result, 'failed': failures }
+
+
+# Append result for node to journal, together with current counters, so that the run may be resumed
+
+def write_journal (node_id, address, result, failures):
+
+	counters = {
+		'tried': tried_count,
+		'geocoded': geocode_count,
+		'failed': failed_count,
+		'nominatim': nominatim_count,
+		'matrikkel': matrikkel_count,
+		'ssr': ssr_count,
+		'cache': cache_count,
+		'memo': memo_count,
+		'repeated_addresses': address_memo_count,
+		'variants': variant_count,
+		'variant_queries': variant_query_count,
+		'hits': hits
+	}
+
+	journal_file.write(json.dumps({ 'id': node_id, 'address': address, 'result': result, 'failed': failures, 'counters': counters },
+									ensure_ascii=False) + "\n")
+	journal_file.flush()
+
+
+# Read results and counters from journal of interrupted run. Returns dict of results by node id, and last counters.
+# Nodes which failed because of unavailable services are not included, so that they are geocoded again.
+
+def read_journal (journal_filename):
+
+	results = {}
+	counters = None
+
+	if os.path.isfile(journal_filename):
+		file = open(journal_filename, encoding="utf-8")
+		for line in file:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				break  # Incomplete last line
+			if entry['result']:
+				entry['result'] = tuple(entry['result'])
+			counters = entry['counters']
+			if entry['failed']:
+				results.pop(entry['id'], None)
+			else:
+				results[ entry['id'] ] = entry
+		file.close()
+
+	return (results, counters)
+
+
+# Read queue of addresses deferred to Nominatim, without repeated nodes
+
+def read_queue (queue_filename):
+
+	deferred_queue = []
+	queued_nodes = set()
+
+	file = open(queue_filename, encoding="utf-8")
+	for line in file:
+		entry = json.loads(line)
+		if entry['id'] not in queued_nodes:
+			deferred_queue.append(entry)
+			queued_nodes.add(entry['id'])
+	file.close()
+
+	return deferred_queue
+
+
+# Wait for geocoding of element to complete, then write it to the output file
+
+def complete_element (element, tags, task, repeated_address):
+
+	if task:
+		address = tags['ADDRESS'].get("v")
+		outcome = finish_address(element.get("id"), address, address, task, repeated_address)
+		if outcome:
+			update_node(element, tags, *outcome, repeated_address)
+
+	output_file.write(ElementTree.tostring(element, encoding="unicode"))
+	stream_root.remove(element)
+
+
+# Wait for geocoding of address of node or row to complete. Returns (result, log lines, failures),
+# or None if the address was not geocoded because of the Nominatim limit or because it was deferred to the Nominatim queue.
+
+def finish_address (object_id, address, query_address, task, repeated_address):
+
+	global nominatim_stopped
+
+	if nominatim_stopped:
+		task.cancel()
+		return None
+
+	# Do only first batch of Nominatim calls if not pausing
+	try:
+		result, address_log, failures = task.result()
+	except NominatimLimitReached:
+		message ("Exceeded %i Nominatim calls per hour\n" % max_nominatim)
+		nominatim_stopped = True
+		return None
+	except NominatimDeferred:
+		message ("- %s --> deferred to Nominatim queue\n" % address)
+		entry = { 'id': object_id, 'address': address }
+		if query_address != address:
+			entry['query'] = query_address
+		queue_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+		queue_file.flush()
+		return None
+
+	# Keep only the result for later objects with the same address
+	if not(repeated_address):
+		address_key = " ".join(address.split())
+		address_memo[address_key] = concurrent.futures.Future()
+		address_memo[address_key].set_result((result, "", failures))
+
+	return (result, address_log, failures)
+
+
+# Write start tag and text of root element to the output file
+
+def write_root_start (root):
+
+	start_tag = ElementTree.tostring(ElementTree.Element(root.tag, root.attrib), encoding="unicode", short_empty_elements=False)
+	output_file.write(start_tag[:start_tag.rindex("</")])
+	if root.text:
+		output_file.write(root.text)
+
+
+# Read, geocode and write elements one by one, with max_workers addresses in parallel
+# and at most stream_window elements in memory. Only saved results are used if geocode is False.
+
+def stream_osm (input_filename, output_filename, geocode):
+
+	global output_file, stream_root
+
+	window = collections.deque()
+	stream_root = None
+	root_written = False
+	depth = 0
+
+	output_file = open(output_filename, "w", encoding="utf-8")
+	output_file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+	for event, element in ElementTree.iterparse(input_filename, events=("start", "end")):
+
+		if event == "start":
+			depth += 1
+			if depth == 1:
+				stream_root = element
+			elif (depth == 2) and not(root_written):
+				write_root_start(stream_root)  # Root text is available at start of first child element
+				root_written = True
+			continue
+
+		depth -= 1
+
+		if depth == 1:
+			tags = None
+			task, repeated_address = None, False
+
+			# Only nodes with a GEOCODE tag are considered, and their tags are indexed once
+			if (element.tag == "node") and len(element):
+				tags = node_tags(element)
+				if "GEOCODE" in tags:
+					task, repeated_address = start_geocoding(element, tags, geocode and not(nominatim_stopped))
+
+			window.append((element, tags, task, repeated_address))
+
+			# Write completed elements in original order
+			while window and ((len(window) > stream_window) or (window[0][2] == None) or window[0][2].done()):
+				if len(window) > stream_window:
+					output_file.flush()
+				complete_element(*window.popleft())
+
+		elif depth == 0:
+			while window:
+				output_file.flush()
+				complete_element(*window.popleft())
+
+			if not(root_written):
+				write_root_start(stream_root)
+			output_file.write("</%s>" % stream_root.tag)
+
+	output_file.close()
+
+
+# Format of input file, given by -format or by file extension
+
+def file_format (filename):
+
+	if input_format:
+		return input_format
+
+	extension = os.path.splitext(filename)[1].lower()
+	if extension == ".csv":
+		return "csv"
+	elif extension in [".geojson", ".json"]:
+		return "geojson"
+	elif extension in [".ndjson", ".geojsonl", ".jsonl"]:
+		return "ndjson"
+	else:
+		return "osm"
+
+
+# Open input or output file, or standard input or output for "-"
+
+def open_table (filename, mode):
+
+	if filename == "-":
+		if mode == "r":
+			return open(sys.stdin.fileno(), mode, encoding="utf-8-sig", newline="", closefd=False)
+		else:
+			return open(sys.stdout.fileno(), mode, encoding="utf-8", newline="", closefd=False)
+	elif mode == "r":
+		return open(filename, mode, encoding="utf-8-sig", newline="")
+	else:
+		return open(filename, mode, encoding="utf-8", newline="")
+
+
+# Read rows of CSV file one by one. The separator (comma, semicolon or tab) is found from the header line.
+# Returns the column names, the separator and an iterator of rows as dicts.
+
+def read_csv_rows (file):
+
+	header = file.readline()
+	try:
+		delimiter = csv.Sniffer().sniff(header, delimiters=",;\t").delimiter
+	except csv.Error:
+		delimiter = ","
+
+	rows = csv.DictReader(itertools.chain([ header ], file), delimiter=delimiter)
+	return (rows.fieldnames or [], delimiter, rows)
+
+
+# Read features of GeoJSON FeatureCollection one by one, without loading the whole file into memory.
+# The text before and after the features array is kept in geojson_frame, so other members are written back unchanged.
+
+def read_geojson_features (file):
+
+	global geojson_frame
+
+	geojson_frame = { 'header': '{"type": "FeatureCollection", "features": [', 'footer': "]}\n" }
+	decoder = json.JSONDecoder()
+	buffer = ""
+	position = 0
+
+	# Find start of features array
+
+	match = None
+	while not(match):
+		chunk = file.read(65536)
+		if not(chunk):
+			return
+		buffer += chunk
+		match = features_pattern.search(buffer)
+
+	geojson_frame['header'] = buffer[ : match.end() ]
+	buffer = buffer[ match.end() : ]
+
+	# Decode one feature at a time, reading more of the file when a feature is not complete
+
+	while True:
+		position = separator_pattern.match(buffer, position).end()
+
+		if position < len(buffer):
+			if buffer[ position ] == "]":
+				geojson_frame['footer'] = buffer[ position : ] + file.read()
+				return
+			try:
+				feature, position = decoder.raw_decode(buffer, position)
+				yield feature
+				continue
+			except ValueError:
+				pass
+
+		chunk = file.read(65536)
+		if not(chunk):
+			if position < len(buffer):
+				message ("\nGeoJSON feature not complete at end of file\n")
+			return
+		buffer = buffer[ position : ] + chunk
+		position = 0
+
+
+# Read features of newline delimited GeoJSON file one by one
+
+def read_ndjson_features (file):
+
+	for line in file:
+		if line.strip():
+			yield json.loads(line)
+
+
+# Read rows of CSV file or features of GeoJSON file one by one.
+# Returns column names and separator (only for CSV files), and iterator of rows or features.
+
+def read_records (input_file):
+
+	if record_format == "csv":
+		return read_csv_rows(input_file)
+	elif record_format == "geojson":
+		return ([], None, read_geojson_features(input_file))
+	else:
+		return ([], None, read_ndjson_features(input_file))
+
+
+# Columns of row, or properties of feature, used the same way as tags of a node
+
+def record_fields (record):
+
+	if record_format == "csv":
+		return record
+
+	if not(isinstance(record.get("properties"), dict)):
+		record['properties'] = {}
+	return record['properties']
+
+
+# Address of row or feature for reporting, and address for geocoding (the same address, or list of street,
+# house number, postcode and city if separate columns are used). Returns (None, None) if no address.
+
+def record_address (fields):
+
+	if address_columns:
+		query_address = [ str(fields.get(column) or "").strip() for column in address_columns ]
+		address = join_address(query_address)
+	else:
+		address = str(fields.get(address_column) or "").strip()
+		query_address = address
+
+	if address:
+		return (address, query_address)
+	else:
+		return (None, None)
+
+
+# Rows and features are geocoded unless a GEOCODE column or property is "no" or "done"
+
+def record_marked (fields):
+
+	return str(fields.get("GEOCODE") or "yes").lower() not in ["no", "done"]
+
+
+# Address line from list of street, house number, postcode and city
+
+def join_address (parts):
+
+	street = " ".join(part for part in parts[0:2] if part)
+	post_district = " ".join(part for part in parts[2:4] if part)
+	return ", ".join(part for part in [ street, post_district ] if part)
+
+
+# Update coordinates and geocoding details of row or feature with geocoding result, in the same way as apply_result for nodes
+
+def apply_record_result (record, fields, result, failures):
+
+	if result:
+		if record is fields:
+			fields['latitude'] = result[0]
+			fields['longitude'] = result[1]
+		else:
+			record['geometry'] = { 'type': "Point", 'coordinates': [ float(result[1]), float(result[0]) ] }
+
+		fields['GEOCODE_METHOD'] = result[2]
+		fields['GEOCODE_RESULT'] = result[3]
+
+		if failures:
+			return  # Geocode again next time
+
+	elif failures:
+		fields['GEOCODE_RESULT'] = "failed"
+		fields.pop("GEOCODE_METHOD", None)
+		return  # Geocode again next time
+
+	else:
+		if fields.get("GEOCODE_RESULT"):
+			fields['GEOCODE_RESULT'] = "no match"
+		else:
+			fields['GEOCODE_RESULT'] = "not found"
+		fields.pop("GEOCODE_METHOD", None)
+
+	if "GEOCODE" in fields:
+		fields['GEOCODE'] = "done"  # Do not geocode next time
+
+
+# Wait for geocoding of row or feature to complete, then write it to the output file
+
+def complete_record (record_id, record, address, query_address, task, repeated_address):
+
+	if task:
+		outcome = finish_address(record_id, address, query_address, task, repeated_address)
+		if outcome:
+			result, address_log, failures = outcome
+			apply_record_result(record, record_fields(record), result, failures)
+			report_result(record_id, address, result, address_log, failures, repeated_address)
+
+	write_record(record)
+
+
+# Write row or feature to the output file
+
+def write_record (record):
+
+	global first_record
+
+	if record_writer:
+		record_writer.writerow(record)
+	elif record_format == "geojson":
+		if first_record:
+			output_file.write(geojson_frame['header'])
+		output_file.write(("\n" if first_record else ",\n") + json.dumps(record, ensure_ascii=False))
+	else:
+		output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+	first_record = False
+
+
+# Read, geocode and write rows of CSV file or features of GeoJSON file one by one, in the same way as stream_osm.
+# Rows are numbered from 1 for the journal. All rows with an address are geocoded, except when a GEOCODE column
+# is "no" or "done". Only saved results are used if geocode is False.
+
+def stream_records (input_filename, output_filename, geocode):
+
+	global output_file, record_format, record_writer, first_record
+
+	window = collections.deque()
+	record_format = file_format(input_filename)
+	record_writer = None
+	first_record = True
+
+	input_file = open_table(input_filename, "r")
+	output_file = open_table(output_filename, "w")
+	columns, delimiter, records = read_records(input_file)
+
+	if record_format == "csv":
+		columns = columns + [ column for column in ["latitude", "longitude", "GEOCODE_METHOD", "GEOCODE_RESULT"] if column not in columns ]
+		record_writer = csv.DictWriter(output_file, fieldnames=columns, delimiter=delimiter, extrasaction="ignore")
+		record_writer.writeheader()
+
+	for record_number, record in enumerate(records, 1):
+
+		record_id = str(record_number)
+		fields = record_fields(record)
+		address, query_address = record_address(fields)
+		task, repeated_address = None, False
+
+		if address and record_marked(fields):
+			task, repeated_address, saved_result = start_address(record_id, address, query_address, geocode and not(nominatim_stopped))
+			if saved_result:
+				apply_record_result(record, fields, saved_result['result'], saved_result['failed'])
+
+		window.append((record_id, record, address, query_address, task, repeated_address))
+
+		# Write completed rows in original order
+		while window and ((len(window) > stream_window) or (window[0][4] == None) or window[0][4].done()):
+			if len(window) > stream_window:
+				output_file.flush()
+			complete_record(*window.popleft())
+
+	while window:
+		output_file.flush()
+		complete_record(*window.popleft())
+
+	if record_format == "geojson":
+		if first_record:
+			output_file.write(geojson_frame['header'])  # No features
+		output_file.write("\n" + geojson_frame['footer'])
+
+	input_file.close()
+	output_file.close()
+
+
+# Read, geocode and write OSM, CSV or GeoJSON file
+
+def stream_file (input_filename, output_filename, geocode):
+
+	if file_format(input_filename) == "osm":
+		stream_osm(input_filename, output_filename, geocode)
+	else:
+		stream_records(input_filename, output_filename, geocode)
+
+
+# Geocode addresses in Nominatim queue, and update output file at regular intervals.
+# Addresses are geocoded from the start, using the responses from Matrikkel and SSR which are already cached.
+
+def geocode_deferred (input_filename, output_filename, deferred_queue):
+
+	global nominatim_stopped
+
+	message ("\nGeocoding %i deferred addresses with Nominatim...\n\n" % len(deferred_queue))
+
+	last_update = time.time()
+
+	for batch_start in range(0, len(deferred_queue), deferred_batch):
+
+		tasks = []
+		batch_memo = {}
+		for entry in deferred_queue[ batch_start : batch_start + deferred_batch ]:
+			address_key = " ".join(entry['address'].split())
+			if address_key in batch_memo:
+				tasks.append((entry, batch_memo[ address_key ], True))
+			elif (address_key in address_memo) and address_memo[ address_key ].done() and \
+					not(address_memo[ address_key ].exception()):
+				tasks.append((entry, address_memo[ address_key ], True))  # Geocoded in earlier batch
+			else:
+				batch_memo[ address_key ] = pool.submit(geocode_task, entry.get("query", entry['address']))
+				address_memo[ address_key ] = batch_memo[ address_key ]
+				tasks.append((entry, batch_memo[ address_key ], False))
+
+		for entry, task, repeated_address in tasks:
+			if nominatim_stopped:
+				task.cancel()
+				continue
+			try:
+				result, address_log, failures = task.result()
+			except NominatimLimitReached:
+				message ("Exceeded %i Nominatim calls per hour\n" % max_nominatim)
+				nominatim_stopped = True
+			else:
+				report_result(entry['id'], entry['address'], result, address_log, failures, repeated_address)
+
+		# Write output file with results so far
+		if (time.time() - last_update > deferred_update) or nominatim_stopped \
+				or (batch_start + deferred_batch >= len(deferred_queue)):
+			stream_file(input_filename, output_filename + ".tmp", False)
+			os.replace(output_filename + ".tmp", output_filename)
+			last_update = time.time()
+
+		if nominatim_stopped:
+			break
+
+
+# Return counters and new municipality bounding boxes of worker process since last time, and reset them
+
+def take_counters():
+
+	global nominatim_count, matrikkel_count, ssr_count, cache_count, memo_count, variant_count, variant_query_count
+	global ssr_not_found, strategy_stats, municipality_bbox_updated
+
+	with count_lock:
+		counters = {
+			'nominatim': nominatim_count,
+			'matrikkel': matrikkel_count,
+			'ssr': ssr_count,
+			'cache': cache_count,
+			'memo': memo_count,
+			'variants': variant_count,
+			'variant_queries': variant_query_count,
+			'ssr_not_found': ssr_not_found,
+			'strategy_stats': strategy_stats,
+			'bbox': municipality_bbox if municipality_bbox_updated else {}
+		}
+
+		nominatim_count = matrikkel_count = ssr_count = cache_count = memo_count = variant_count = variant_query_count = 0
+		ssr_not_found = []
+		strategy_stats = {}
+		municipality_bbox_updated = False
+
+	return counters
+
+
+# Add counters from worker process
+
+def add_counters (counters):
+
+	global nominatim_count, matrikkel_count, ssr_count, cache_count, memo_count, variant_count, variant_query_count
+	global municipality_bbox_updated
+
+	nominatim_count += counters['nominatim']
+	matrikkel_count += counters['matrikkel']
+	ssr_count += counters['ssr']
+	cache_count += counters['cache']
+	memo_count += counters['memo']
+	variant_count += counters['variants']
+	variant_query_count += counters['variant_queries']
+
+	for name_type in counters['ssr_not_found']:
+		if name_type not in ssr_not_found:
+			ssr_not_found.append(name_type)
+
+	for strategy, stats in counters['strategy_stats'].items():
+		if strategy not in strategy_stats:
+			strategy_stats[ strategy ] = new_strategy_stats()
+		strategy_stats[ strategy ]['hits'] += stats['hits']
+		strategy_stats[ strategy ]['network'].extend(stats['network'])
+		strategy_stats[ strategy ]['cached'].extend(stats['cached'])
+
+	for municipality_ref, bbox in counters['bbox'].items():
+		if municipality_ref not in municipality_bbox:
+			municipality_bbox[ municipality_ref ] = bbox
+			municipality_bbox_updated = True
+
+
+# Prepare worker process with the settings of the main process, and rate limiters and Nominatim lock
+# shared with the other processes
+
+def init_process (settings, shared_limiters, shared_nominatim_lock):
+
+	global pool, cache_commit, nominatim_lock
+
+	globals().update(settings)
+	nominatim_lock = shared_nominatim_lock  # Nominatim limit is checked one query at a time across processes
+	init_geocoding()
+
+	for backend, (lock, call_times, call_count) in shared_limiters.items():
+		rate_limiters[ backend ] = SharedRateLimiter(backend.capitalize(), rate_limits[ backend ], lock, call_times, call_count)
+
+	cache_commit = 1  # Do not keep the cache file locked for other processes
+	pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+
+# Geocode addresses in worker process. Returns results with log lines and failed services in the same order,
+# the counters of the process and whether the Nominatim limit was reached.
+
+def geocode_shard (addresses):
+
+	results = []
+	limit_reached = False
+
+	try:
+		for outcome in pool.map(geocode_task, addresses):
+			results.append(outcome)
+	except NominatimLimitReached:
+		limit_reached = True
+
+	return (results, take_counters(), limit_reached)
+
+
+# Read nodes, rows or features to be geocoded from input file. Returns dict of ids, addresses and query addresses
+# for each address, in file order. Objects with results from an interrupted run are not included.
+
+def collect_addresses (input_filename):
+
+	addresses = {}
+
+	if file_format(input_filename) == "osm":
+		objects = osm_addresses(input_filename)
+	else:
+		objects = record_addresses(input_filename)
+
+	for object_id, address, query_address in objects:
+		if not((object_id in saved_results) and (saved_results[ object_id ]['address'] == address)):
+			addresses.setdefault(" ".join(address.split()), []).append((object_id, address, query_address))
+
+	return addresses
+
+
+# Iterate id and address of nodes marked with GEOCODE tag in OSM file
+
+def osm_addresses (input_filename):
+
+	depth = 0
+
+	for event, element in ElementTree.iterparse(input_filename, events=("start", "end")):
+
+		if event == "start":
+			depth += 1
+			continue
+
+		depth -= 1
+
+		if depth == 1:
+			if (element.tag == "node") and len(element):
+				tags = node_tags(element)
+				if ("GEOCODE" in tags) and ("ADDRESS" in tags) and (tags['GEOCODE'].get("v").lower() not in ["no", "done"]):
+					yield (element.get("id"), tags['ADDRESS'].get("v"), tags['ADDRESS'].get("v"))
+			element.clear()
+
+
+# Iterate id, address and query address of rows or features to be geocoded in CSV or GeoJSON file
+
+def record_addresses (input_filename):
+
+	global record_format
+
+	record_format = file_format(input_filename)
+	input_file = open_table(input_filename, "r")
+	columns, delimiter, records = read_records(input_file)
+
+	for record_number, record in enumerate(records, 1):
+		fields = record_fields(record)
+		address, query_address = record_address(fields)
+		if address and record_marked(fields):
+			yield (str(record_number), address, query_address)
+
+	input_file.close()
+
+
+# Geocode addresses in several processes, with addresses partitioned by municipality,
+# then write output file in the original order using the results.
+
+def geocode_processes (input_filename, output_filename):
+
+	global nominatim_stopped
+
+	addresses = collect_addresses(input_filename)
+
+	# Partition addresses by municipality of postcode, starting with the largest municipalities
+
+	municipalities = {}
+	for address_key, nodes in addresses.items():
+		query_address = nodes[0][2]
+		if isinstance(query_address, str):
+			postcode = split_address(query_address).postcode
+		else:
+			postcode = fields_address(*query_address).postcode
+		municipality_ref = post_districts[ postcode ]['municipality_ref'] if postcode in post_districts else ""
+		municipalities.setdefault(municipality_ref, []).append(address_key)
+
+	shards = []
+	for municipality_ref, address_keys in sorted(municipalities.items(), key=lambda municipality: -len(municipality[1])):
+		for shard_start in range(0, len(address_keys), shard_size):
+			shards.append(address_keys[ shard_start : shard_start + shard_size ])
+
+	message ("Geocoding %i addresses in %i municipalities with %i processes...\n\n" % (len(addresses), len(municipalities), max_processes))
+
+	# Rate limits are shared by all processes
+
+	context = multiprocessing.get_context("spawn")
+	shared_limiters = {}
+	for backend, limits in rate_limits.items():
+		if limits:
+			shared_limiters[ backend ] = (context.Lock(), context.Array("d", max(max_calls for max_calls, period in limits), lock=False),
+											context.Value("i", 0, lock=False))
+
+	settings = { name: globals()[ name ] for name in ['query_cache', 'cache_readonly', 'max_workers', 'speculative', 'matrikkel_extract',
+						'ssr_extract', 'precision_target', 'strategies_filename', 'log_level', 'pause_nominatim', 'max_nominatim'] }
+
+	process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_processes, mp_context=context,
+															initializer=init_process, initargs=(settings, shared_limiters, context.Lock()))
+
+	tasks = { process_pool.submit(geocode_shard, [ addresses[ address_key ][0][2] for address_key in shard ]): shard for shard in shards }
+
+	# Shards not yet started are cancelled when the Nominatim limit is reached, but results from running shards are kept
+
+	for task in concurrent.futures.as_completed(tasks):
+		if task.cancelled():
+			continue
+
+		results, counters, limit_reached = task.result()
+		add_counters(counters)
+
+		for address_key, (result, address_log, failures) in zip(tasks[ task ], results):
+			for index, (node_id, address, query_address) in enumerate(addresses[ address_key ]):
+				report_result(node_id, address, result, address_log, failures, index > 0)
+
+		if limit_reached and not(nominatim_stopped):
+			message ("Exceeded %i Nominatim calls per hour\n" % max_nominatim)
+			nominatim_stopped = True
+			for pending_task in tasks:
+				pending_task.cancel()
+
+	process_pool.shutdown()
+
+	# Write output file with the results
+
+	stream_file(input_filename, output_filename, False)
+
+
+# Load geocoding strategies from JSON file, or use the built-in strategies
+
+def load_strategies (filename):
+
+	if filename:
+		file = open(filename, encoding="utf-8")
+		config = json.load(file)
+		file.close()
+	else:
+		config = default_strategies
+
+	strategies = []
+	for step, strategy in enumerate(config, 1):
+		if not(isinstance(strategy, dict)) or strategy.get('backend') not in ["matrikkel", "ssr", "nominatim"] \
+				or strategy.get('quality') not in precisions or not(strategy.get('method')) or not(strategy.get('query')) \
+				or not(all(isinstance(strategy.get(field, []), list) and all(isinstance(part, str) for part in strategy.get(field, []))
+							for field in ['query', 'requires', 'without'])) \
+				or not(set(strategy['query'] + strategy.get('requires', []) + strategy.get('without', [])) <= set(ParsedAddress.__slots__)):
+			message ("\nStrategy not valid in '%s': %s\n" % (filename, json.dumps(strategy, ensure_ascii=False)))
+			sys.exit()
+		strategies.append(Strategy(strategy, step))
+
+	return strategies
+
+
+# Select strategies for the precision target, in the configured order. Strategies testing street name variants
+# for a more precise result than the target are skipped, since they need many queries. Other strategies are kept,
+# as a more precise result also meets the target.
+
+def select_strategies (strategies, target):
+
+	target_rank = precisions.index(target)
+
+	return [ strategy for strategy in strategies if not(strategy.variants and (precisions.index(strategy.quality) < target_rank)) ]
+
+
+# Load registers, cache and strategies, and prepare services. Done once before the first address is geocoded.
+
+def init_geocoding():
+
+	global rate_limiters, circuit_breakers, pipeline, speculative_pool, geocoding_ready
+
+	# Rate limits and circuit breakers for each service
+
+	rate_limiters = { backend: RateLimiter(backend.capitalize(), limits) for backend, limits in rate_limits.items() }
+	circuit_breakers = { backend: CircuitBreaker(backend.capitalize()) for backend in rate_limits }
+
+	load_post_districts()
+	read_municipality_bbox()
+	open_cache()
+	open_matrikkel_register()
+	open_ssr_register()
+
+	pipeline = select_strategies(load_strategies(strategies_filename), precision_target)
+	speculative_pool = concurrent.futures.ThreadPoolExecutor(max_workers=speculative_workers)
+	geocoding_ready = True
+
+	atexit.register(close_geocoding)
+
+
+# Save new municipality bounding boxes and cached responses
+
+def close_geocoding():
+
+	save_municipality_bbox()
+	close_cache()
+
+
+# Geocode address, for use as a library. Returns (latitude, longitude, method, precision) or None if not found.
+# Address format: "Skøyen skole, Lørenveien 7, 0585 Oslo" (optional first part)
+
+def geocode (address):
+
+	if not(geocoding_ready):
+		init_geocoding()
+
+	result, address_log, failures = geocode_task(address)
+	return result
+
+
+# Address for geocoding from item in request to geocoding service: an address string, an object with "address",
+# or an object with "street", "number", "postcode" and "city". Returns (address, query address), or (None, None) if not valid.
+
+def request_address (item):
+
+	if isinstance(item, dict):
+		if item.get("address"):
+			item = item['address']
+		elif any(item.get(key) for key in ["street", "number", "postcode", "city"]):
+			query_address = [ str(item.get(key) or "").strip() for key in ["street", "number", "postcode", "city"] ]
+			return (join_address(query_address), query_address)
+
+	if isinstance(item, str) and item.strip():
+		return (item.strip(), item.strip())
+	else:
+		return (None, None)
+
+
+# Geocode addresses of request in worker threads, and return JSON result for each address
+
+async def geocode_request (items):
+
+	global tried_count, geocode_count, failed_count
+
+	loop = asyncio.get_running_loop()
+	addresses = [ request_address(item) for item in items ]
+	outcomes = await asyncio.gather(*[ loop.run_in_executor(pool, geocode_task, query_address)
+										for address, query_address in addresses if address ])
+
+	results = []
+	for address, query_address in addresses:
+		if not(address):
+			results.append({ 'address': None, 'found': False, 'error': "address missing" })
+			continue
+
+		result, address_log, failures = outcomes.pop(0)
+		log_lines(address_log)
+
+		tried_count += 1
+		if result:
+			if failures:
+				failed_count += 1  # More precise strategies may have been skipped
+			else:
+				geocode_count += 1
+				hits[ result[3] ] += 1
+			results.append({ 'address': address, 'found': True, 'latitude': float(result[0]), 'longitude': float(result[1]),
+								'method': result[2], 'precision': result[3], 'failed': failures })
+		else:
+			if failures:
+				failed_count += 1
+			results.append({ 'address': address, 'found': False, 'failed': failures })
+
+	with bbox_lock:
+		save_municipality_bbox()
+
+	return results
+
+
+# Answer request to geocoding service. Returns HTTP status and JSON response.
+# GET /geocode?address=... geocodes one address, POST /geocode with JSON object or list geocodes one address or a batch,
+# and GET /status returns counters since the service was started.
+
+async def answer_request (method, target, body):
+
+	url = urllib.parse.urlsplit(target)
+
+	if url.path == "/status":
+		return ("200 OK", {
+			'version': version,
+			'geocoded': geocode_count,
+			'tried': tried_count,
+			'failed': failed_count,
+			'hits': hits,
+			'queries': { 'nominatim': nominatim_count, 'matrikkel': matrikkel_count, 'ssr': ssr_count },
+			'cached_responses': { 'cache_file': cache_count, 'memory': memo_count }
+			})
+
+	if url.path != "/geocode":
+		return ("404 Not Found", { 'error': "unknown path, use /geocode or /status" })
+
+	if method == "GET":
+		items = urllib.parse.parse_qs(url.query).get("address", [])
+		if len(items) != 1:
+			return ("400 Bad Request", { 'error': "one address parameter required" })
+		return ("200 OK", (await geocode_request(items))[0])
+
+	elif method == "POST":
+		try:
+			request = json.loads(body.decode("utf-8"))
+		except ValueError:
+			return ("400 Bad Request", { 'error': "request is not valid JSON" })
+
+		if isinstance(request, list):
+			if len(request) > server_batch:
+				return ("413 Payload Too Large", { 'error': "max %i addresses in one request" % server_batch })
+			return ("200 OK", await geocode_request(request))
+		else:
+			return ("200 OK", (await geocode_request([ request ]))[0])
+
+	else:
+		return ("405 Method Not Allowed", { 'error': "use GET or POST" })
+
+
+# Read HTTP requests from client connection and answer them, until the client closes the connection
+
+async def serve_connection (reader, writer):
+
+	try:
+		while True:
+			request_line = await reader.readline()
+			if not(request_line.strip()):
+				break
+
+			headers = {}
+			while True:
+				line = await reader.readline()
+				if not(line.strip()):
+					break
+				name, separator, value = line.decode("latin-1").partition(":")
+				headers[ name.strip().lower() ] = value.strip()
+
+			try:
+				method, target, protocol = request_line.decode("latin-1").split()
+				body_size = int(headers.get("content-length", "0"))
+				if body_size < 0:
+					raise ValueError("negative Content-Length")
+			except ValueError:
+				status, response = ("400 Bad Request", { 'error': "not a valid HTTP request" })
+				protocol = "HTTP/1.0"  # Close connection, as the rest of the request cannot be read
+			else:
+				if body_size > server_request_size:
+					status, response = ("413 Payload Too Large", { 'error': "max %i bytes in one request" % server_request_size })
+					protocol = "HTTP/1.0"  # Close connection without reading the body
+				else:
+					body = await reader.readexactly(body_size)
+					try:
+						status, response = await answer_request(method.upper(), target, body)
+					except Exception as error:  # Answer the client also when geocoding fails unexpectedly
+						log ("warning", "server_error", request=target, error="%s: %s" % (type(error).__name__, error))
+						status, response = ("500 Internal Server Error", { 'error': "%s: %s" % (type(error).__name__, error) })
+
+			keep_alive = (protocol == "HTTP/1.1") and (headers.get("connection", "").lower() != "close")
+			content = json.dumps(response, ensure_ascii=False).encode("utf-8")
+			writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: %i\r\n%s\r\n" %
+							(status, len(content), "" if keep_alive else "Connection: close\r\n")).encode("latin-1") + content)
+			await writer.drain()
+
+			if not(keep_alive):
+				break
+
+	except (ConnectionError, asyncio.IncompleteReadError):
+		pass
+
+	finally:
+		writer.close()
+
+
+# Run geocoding service on local network port, or on Unix socket if a path is given, until stopped.
+# Registers, SSR name types, bounding boxes and cached responses are kept in memory between requests.
+
+async def serve (server_address):
+
+	if server_address.isdigit():
+		server = await asyncio.start_server(serve_connection, server_host, int(server_address))
+		message ("\nGeocoding service at http://%s:%s/geocode\n" % (server_host, server_address))
+	else:
+		if os.path.exists(server_address) and stat.S_ISSOCK(os.stat(server_address).st_mode):
+			os.remove(server_address)  # Socket left from earlier service
+		server = await asyncio.start_unix_server(serve_connection, server_address)
+		message ("\nGeocoding service at Unix socket '%s'\n" % server_address)
+
+	stopped = asyncio.Event()
+	try:
+		for signal_number in [ signal.SIGINT, signal.SIGTERM ]:
+			asyncio.get_running_loop().add_signal_handler(signal_number, stopped.set)
+	except NotImplementedError:
+		pass  # Stopped by KeyboardInterrupt on Windows
+
+	async with server:
+		await stopped.wait()
+
+	if not(server_address.isdigit()):
+		os.remove(server_address)
+
+	message ("\nGeocoding service stopped after %i addresses\n" % tried_count)
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	if (len(sys.argv) > 1) and (sys.argv[1] == "-"):
+		message_file = sys.stderr  # Output file is written to standard output
+
+	message ("\nLoading data...")
+	
+	if len(sys.argv) > 1:
+		filename = sys.argv[1]
+	else:
+		message ("Please include input osm filename as parameter\n")
+		sys.exit()
+
+	if "-nocache" in sys.argv:
+		query_cache = False
+	if "-readonly" in sys.argv:
+		cache_readonly = True
+	if "-workers" in sys.argv:
+		max_workers = int(sys.argv[ sys.argv.index("-workers") + 1 ])
+	if "-processes" in sys.argv:
+		max_processes = int(sys.argv[ sys.argv.index("-processes") + 1 ])
+	if "-speculative" in sys.argv:
+		speculative = True
+	if "-matrikkel" in sys.argv:
+		matrikkel_extract = sys.argv[ sys.argv.index("-matrikkel") + 1 ]
+	if "-ssr" in sys.argv:
+		ssr_extract = sys.argv[ sys.argv.index("-ssr") + 1 ]
+	resume = "-resume" in sys.argv
+	if "-deferred" in sys.argv:
+		defer_nominatim = True
+		if max_processes > 1:
+			message ("\nDeferred Nominatim queries are not supported with several processes\n")
+			sys.exit()
+	refresh_registers = "-refresh" in sys.argv
+	if "-debug" in sys.argv:
+		log_level = "debug"
+
+	if "-precision" in sys.argv:
+		precision_target = sys.argv[ sys.argv.index("-precision") + 1 ].lower().replace("_", " ")
+		if precision_target not in precisions:
+			message ("Precision must be one of: %s\n" % ", ".join(precisions))
+			sys.exit()
+	if "-strategies" in sys.argv:
+		strategies_filename = sys.argv[ sys.argv.index("-strategies") + 1 ]
+
+	if "-format" in sys.argv:
+		input_format = sys.argv[ sys.argv.index("-format") + 1 ].lower()
+		if input_format not in ["osm", "csv", "geojson", "ndjson"]:
+			message ("Format must be one of: osm, csv, geojson, ndjson\n")
+			sys.exit()
+	if "-address" in sys.argv:
+		address_column = sys.argv[ sys.argv.index("-address") + 1 ]
+	if "-columns" in sys.argv:
+		address_columns = [ column.strip() for column in sys.argv[ sys.argv.index("-columns") + 1 ].split(",") ]
+		if len(address_columns) != 4:
+			message ("Please give columns for street, house number, postcode and city, for example: -columns street,number,postcode,city\n")
+			sys.exit()
+
+	if filename == "-":
+		if file_format(filename) == "osm":
+			message ("Please give format of standard input with -format csv, geojson or ndjson\n")
+			sys.exit()
+		if defer_nominatim or (max_processes > 1):
+			message ("Standard input is read only once, so -deferred and -processes are not available\n")
+			sys.exit()
+
+	# Load registers, cache and strategies
+
+	init_geocoding()
+
+	# Load bounding boxes of all municipalities
+
+	if "-bbox" in sys.argv:
+		download_municipality_bbox()
+
+	# Run geocoding service, with registers and caches kept in memory between requests
+
+	if "-serve" in sys.argv:
+		require_ssr_types()
+		pause_nominatim = True  # Nominatim quota is renewed during the hour
+		quota_wait = server_quota_wait  # Requests do not wait long for the rate limit of a service
+		pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+		log_filename = "geocode2osm_geocodelog.txt"
+		stats_filename = "geocode2osm_geocodestats"
+		log_writer = LogWriter(log_filename, "a")  # Log is kept when the service is restarted
+
+		try:
+			asyncio.run(serve(sys.argv[ sys.argv.index("-serve") + 1 ]))
+		except KeyboardInterrupt:
+			pass
+
+		pool.shutdown(cancel_futures=True)
+		speculative_pool.shutdown(cancel_futures=True)
+		close_geocoding()
+
+		message ("Detailed log in file '%s'\n" % log_filename)
+		if stats_report and strategy_stats:
+			save_stats_report(stats_filename + ".json", stats_filename + ".csv")
+			message ("Report of geocoding methods in files '%s.json' and '%s.csv'\n" % (stats_filename, stats_filename))
+		log_writer.close()
+		sys.exit()
+
+	# Init output files
+
+	if file_format(filename) == "osm":
+		message ("\nGeocoding ADDRESS tag for objects marked with GEOCODE tag in file '%s'...\n\n" % filename)
+	elif address_columns:
+		message ("\nGeocoding columns %s in file '%s'...\n\n" % (", ".join(address_columns), filename))
+	else:
+		message ("\nGeocoding %s column in file '%s'...\n\n" % (address_column, filename))
+
+	# Output file is written to standard output for standard input, and other files are named after the program
+
+	if filename == "-":
+		base_filename = "geocode2osm"
+		output_filename = "-"
+	elif file_format(filename) != "osm":
+		base_filename, extension = os.path.splitext(filename)
+		output_filename = base_filename + "_geocoded" + extension
+	elif filename.find(".osm") >= 0:
+		base_filename = filename.replace(".osm", "")
+		output_filename = base_filename + "_geocoded.osm"
+	else:
+		base_filename = filename
+		output_filename = base_filename + "_geocoded.osm"
+
+	log_filename = base_filename + "_geocodelog.txt"
+	journal_filename = base_filename + "_geocodejournal.txt"
+	stats_filename = base_filename + "_geocodestats"
+	queue_filename = base_filename + "_geocodequeue.txt"
+
+	if resume:
+		log_writer = LogWriter(log_filename, "a")
+	else:
+		log_writer = LogWriter(log_filename, "w")
+
+	# Restore results and counters from journal of interrupted run
+
+	saved_results = {}
+
+	if resume:
+		saved_results, counters = read_journal(journal_filename)
+		if counters:
+			tried_count = counters['tried'] - counters['failed']  # Failed nodes are geocoded again
+			geocode_count = counters['geocoded']
+			nominatim_count = counters['nominatim']
+			matrikkel_count = counters['matrikkel']
+			ssr_count = counters['ssr']
+			cache_count = counters['cache']
+			memo_count = counters['memo']
+			address_memo_count = counters['repeated_addresses']
+			variant_count = counters['variants']
+			variant_query_count = counters['variant_queries']
+			hits = counters['hits']
+
+			for entry in saved_results.values():
+				address_memo[ " ".join(entry['address'].split()) ] = concurrent.futures.Future()
+				address_memo[ " ".join(entry['address'].split()) ].set_result((entry['result'], "", []))
+
+		message ("Resuming with %i geocoded objects from '%s'\n\n" % (len(saved_results), journal_filename))
+		log ("info", "resume", objects=len(saved_results), journal=journal_filename)
+		journal_file = open(journal_filename, "a", encoding="utf-8")
+	else:
+		journal_file = open(journal_filename, "w", encoding="utf-8")
+
+	# Geocode all elements. If Nominatim queries are deferred, do them after all other addresses are completed.
+
+	pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+	nominatim_stopped = False
+	nominatim_deferred = defer_nominatim
+
+	queue_file = open(queue_filename, "w", encoding="utf-8")
+	if max_processes > 1:
+		geocode_processes(filename, output_filename)
+	else:
+		stream_file(filename, output_filename, True)
+	queue_file.close()
+
+	if nominatim_deferred:
+		nominatim_deferred = False
+		deferred_queue = read_queue(queue_filename)
+		if deferred_queue and not(nominatim_stopped):
+			geocode_deferred(filename, output_filename, deferred_queue)
+
+	journal_file.close()
+
+	if not(nominatim_stopped):
+		os.remove(journal_filename)  # Output file is complete
+		os.remove(queue_filename)
+
+	pool.shutdown(cancel_futures=True)
+	speculative_pool.shutdown(cancel_futures=True)
+
+	# Wrap up
+
+	log ("info", "summary", nominatim_queries=nominatim_count, matrikkel_queries=matrikkel_count, ssr_queries=ssr_count,
+			cached_responses=cache_count, repeated_queries=memo_count, repeated_addresses=address_memo_count,
+			variants_generated=variant_count, variants_queried=variant_query_count, hits=hits, failed=failed_count,
+			no_hits=(tried_count - geocode_count - failed_count))
+
+	if output_filename == "-":
+		message ("\nGeocoded %i of %i objects, written to standard output\n" % (geocode_count, tried_count))
+	else:
+		message ("\nGeocoded %i of %i objects, written to file '%s'\n" % (geocode_count, tried_count, output_filename))
 	message ("Hits: %i houses (exact addresses), %i streets, %i places (villages, towns), %i post code districts\n" % \
 				(hits['house'], hits['street'], hits['place'], hits['post district']))
 	message ("Nominatim queries: %i (max approx. 600/hour)\n" % nominatim_count)
-	message ("Detailed log in file '%s'\n\n" % log_filename)
+	if cache_count or memo_count:
+		message ("Cached responses: %i of %i lookups (%i from cache file, %i repeated during run)\n" % \
+					(cache_count + memo_count, nominatim_count + matrikkel_count + ssr_count + cache_count + memo_count,
+						cache_count, memo_count))
+	if address_memo_count:
+		message ("Repeated addresses: %i\n" % address_memo_count)
+	if failed_count:
+		message ("Failed: %i objects because services were not available - run again to retry them\n" % failed_count)
+	message ("Detailed log in file '%s'\n" % log_filename)
+	if stats_report:
+		save_stats_report(stats_filename + ".json", stats_filename + ".csv")
+		message ("Report of geocoding methods in files '%s.json' and '%s.csv'\n" % (stats_filename, stats_filename))
+	message ("\n")
 
 	if ssr_not_found:
 		message ("SSR name types not found: %s - please post issue at 'https://github.com/osmno/geocode2osm'\n" % str(ssr_not_found))
 
-	log_file.close()
+	close_geocoding()
+	log_writer.close()